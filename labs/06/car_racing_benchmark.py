@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Measure CarRacing physics throughput (no rendering)."""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import car_racing_evaluator
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+parser.add_argument("--steps", default=2000, type=int, help="Physics steps to measure.")
+args = parser.parse_args()
+
+env = car_racing_evaluator.CarRacingCustomDraw()
+env.seed(args.seed)
+env.reset()
+np.random.seed(args.seed)
+actions = np.random.uniform([-1, 0, 0], [1, 1, 0.5], size=[args.steps, 3])
+
+car_time, world_time = 0, 0
+for action in actions:
+    env.car.steer(-action[0])
+    env.car.gas(action[1])
+    env.car.brake(action[2])
+
+    start = time.perf_counter()
+    env.car.step(1.0/car_racing_evaluator.FPS)
+    car_time += time.perf_counter() - start
+
+    start = time.perf_counter()
+    env.world.Step(1.0/car_racing_evaluator.FPS, 6*30, 2*30)
+    world_time += time.perf_counter() - start
+
+print("Car.step: {:.1f} us/step, world.Step: {:.1f} us/step, physics: {:.0f} steps/s".format(
+    1e6 * car_time / args.steps, 1e6 * world_time / args.steps, args.steps / (car_time + world_time)), file=sys.stderr)
@@ -36,23 +36,18 @@ class Network:
 
 			# Compute the q_values
 			if args.cnn is None:
-				# preprocess image
-				resized_input = tf.image.resize_images(self.states, size=[48, 48])
-				grayscale_input = tf.image.rgb_to_grayscale(resized_input)
-				flattened_input = tf.layers.flatten(grayscale_input)
+				# the environment already renders small grayscale images
+				flattened_input = tf.layers.flatten(self.states)
 
 				hidden = flattened_input
 				for _ in range(args.hidden_layers):
 					hidden = tf.layers.dense(hidden, args.hidden_layer_size, activation=tf.nn.relu)
 				self.predicted_values = tf.layers.dense(hidden, num_actions, name="output_layer")
 			else:
-				# preprocess image
-				resized_input = tf.image.resize_images(self.states, size=[96, 96])
-
 				cnn_desc = args.cnn.split(',')
 				depth = len(cnn_desc)
 				layers = [None] * (1 + depth)
-				layers[0] = resized_input
+				layers[0] = self.states
 				for l in range(depth):
 					layer_idx = l + 1
 					layer_name = "layer{}-{}".format(l, cnn_desc[l])
@@ -172,8 +167,11 @@ if __name__ == "__main__":
 			if not os.path.exists("logs"):
 				os.mkdir("logs") # TF 1.6 will do this by itself
 
-		# Create the environment
-		env = car_racing_evaluator.environment()
+		# Create the environment; without a CNN, render 48x48 grayscale observations directly
+		if args.cnn is None:
+			env = car_racing_evaluator.environment(width=48, height=48, grayscale=True)
+		else:
+			env = car_racing_evaluator.environment()
 		discrete_steer = [-1, 0, 1]
 		discrete_gas = [0, 1]
 		discrete_brake = [0, 1]
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 """The CarRacing-v0 environment from Gym, adapted not to use OpenGL"""
+import collections
+import functools
+import json
 import math
+import os
 import sys
+import time
 
 import numpy as np
 
@@ -61,8 +66,9 @@ WHEEL_WHITE = (0.3,0.3,0.3)
 MUD_COLOR   = (0.4,0.4,0.0)
 
 class Car:
-    def __init__(self, world, init_angle, init_x, init_y):
+    def __init__(self, world, init_angle, init_x, init_y, headless=False):
         self.world = world
+        self.headless = headless  # Skip skid particles and fuel accounting
         self.hull = self.world.CreateDynamicBody(
             position = (init_x, init_y),
             angle = init_angle,
@@ -122,7 +128,7 @@ class Car:
 
     def gas(self, gas):
         'control: rear wheel drive'
-        gas = np.clip(gas, 0, 1)
+        gas = min(max(gas, 0), 1)
         for w in self.wheels[2:4]:
             diff = gas - w.gas
             if diff > 0.1: diff = 0.1  # gradually increase, but stop immediately
@@ -141,9 +147,7 @@ class Car:
     def step(self, dt):
         for w in self.wheels:
             # Steer each wheel
-            dir = np.sign(w.steer - w.joint.angle)
-            val = abs(w.steer - w.joint.angle)
-            w.joint.motorSpeed = dir*min(50.0*val, 3.0)
+            w.joint.motorSpeed = min(max(50.0*(w.steer - w.joint.angle), -3.0), 3.0)
 
             # Position => friction_limit
             grass = True
@@ -153,52 +157,53 @@ class Car:
                 grass = False
 
             # Force
-            forw = w.GetWorldVector( (0,1) )
-            side = w.GetWorldVector( (1,0) )
+            rotation = w.transform.q  # GetWorldVector( (0,1) ) is (-sin, cos), GetWorldVector( (1,0) ) is (cos, sin)
+            sin, cos = rotation.s, rotation.c
             v = w.linearVelocity
-            vf = forw[0]*v[0] + forw[1]*v[1]  # forward speed
-            vs = side[0]*v[0] + side[1]*v[1]  # side speed
+            vx, vy = v[0], v[1]
+            vf = cos*vy - sin*vx  # forward speed
+            vs = cos*vx + sin*vy  # side speed
 
             # WHEEL_MOMENT_OF_INERTIA*np.square(w.omega)/2 = E -- energy
             # WHEEL_MOMENT_OF_INERTIA*w.omega * domega/dt = dE/dt = W -- power
             # domega = dt*W/WHEEL_MOMENT_OF_INERTIA/w.omega
             w.omega += dt*ENGINE_POWER*w.gas/WHEEL_MOMENT_OF_INERTIA/(abs(w.omega)+5.0)  # small coef not to divide by zero
-            self.fuel_spent += dt*ENGINE_POWER*w.gas
+            if not self.headless: self.fuel_spent += dt*ENGINE_POWER*w.gas
 
             if w.brake >= 0.9:
                 w.omega = 0
             elif w.brake > 0:
                 BRAKE_FORCE = 15    # radians per second
-                dir = -np.sign(w.omega)
-                val = BRAKE_FORCE*w.brake
-                if abs(val) > abs(w.omega): val = abs(w.omega)  # low speed => same as = 0
-                w.omega += dir*val
+                val = min(BRAKE_FORCE*w.brake, abs(w.omega))  # low speed => same as = 0
+                if w.omega > 0: w.omega -= val
+                elif w.omega < 0: w.omega += val
             w.phase += w.omega*dt
 
             vr = w.omega*w.wheel_rad  # rotating wheel speed
-            f_force = -vf + vr        # force direction is direction of speed difference
+            f_force = vr - vf         # force direction is direction of speed difference
             p_force = -vs
 
             # Physically correct is to always apply friction_limit until speed is equal.
             # But dt is finite, that will lead to oscillations if difference is already near zero.
             f_force *= 205000*SIZE*SIZE  # Random coefficient to cut oscillations in few steps (have no effect on friction_limit)
             p_force *= 205000*SIZE*SIZE
-            force = np.sqrt(np.square(f_force) + np.square(p_force))
+            force = math.sqrt(f_force*f_force + p_force*p_force)
 
             # Skid trace
-            if abs(force) > 2.0*friction_limit:
-                if w.skid_particle and w.skid_particle.grass==grass and len(w.skid_particle.poly) < 30:
-                    w.skid_particle.poly.append( (w.position[0], w.position[1]) )
-                elif w.skid_start is None:
-                    w.skid_start = w.position
+            if not self.headless:
+                if force > 2.0*friction_limit:
+                    if w.skid_particle and w.skid_particle.grass==grass and len(w.skid_particle.poly) < 30:
+                        w.skid_particle.poly.append( (w.position[0], w.position[1]) )
+                    elif w.skid_start is None:
+                        w.skid_start = w.position
+                    else:
+                        w.skid_particle = self._create_particle( w.skid_start, w.position, grass )
+                        w.skid_start = None
                 else:
-                    w.skid_particle = self._create_particle( w.skid_start, w.position, grass )
                     w.skid_start = None
-            else:
-                w.skid_start = None
-                w.skid_particle = None
+                    w.skid_particle = None
 
-            if abs(force) > friction_limit:
+            if force > friction_limit:
                 f_force /= force
                 p_force /= force
                 force = friction_limit  # Correct physics here
@@ -208,8 +213,8 @@ class Car:
             w.omega -= dt*f_force*w.wheel_rad/WHEEL_MOMENT_OF_INERTIA
 
             w.ApplyForceToCenter( (
-                p_force*side[0] + f_force*forw[0],
-                p_force*side[1] + f_force*forw[1]), True )
+                p_force*cos - f_force*sin,
+                p_force*sin + f_force*cos), True )
 
     def draw(self, viewer, draw_particles=True):
         if draw_particles:
@@ -256,6 +261,161 @@ class Car:
             self.world.DestroyBody(w)
         self.wheels = []
 
+class KinematicCars:
+    """Fast surrogate of the Box2D `Car`: a kinematic bicycle model of several cars.
+
+    The controls (steer, gas, brake) and the wheel rotation (engine, brakes and
+    traction up to the friction limit) follow `Car`, but the hull moves without
+    lateral slip, turning with the front wheels around the rear axle. All methods
+    work on NumPy arrays with one row per car.
+    """
+    MASS = 7.3                        # Hull and wheels of the Box2D car
+    WHEEL_RAD = WHEEL_R*SIZE
+    WHEELBASE = (WHEELPOS[0][1] - WHEELPOS[2][1])*SIZE
+    TRACTION = 205000*SIZE*SIZE       # Same coefficient as in `Car.step`
+
+    def __init__(self, cars):
+        self.position = np.zeros([cars, 2])
+        self.angle = np.zeros(cars)
+        self.speed = np.zeros(cars)       # forward speed
+        self.angular_velocity = np.zeros(cars)
+        self.steering = np.zeros(cars)    # front wheels angle
+        self.target_steering = np.zeros(cars)
+        self.wheel_gas = np.zeros(cars)
+        self.wheel_brake = np.zeros(cars)
+        self.omega = np.zeros([cars, 4])
+        self.phase = np.zeros([cars, 4])
+        self._wheel_cos = np.ones([cars, 4])
+
+    def place(self, cars, init_angle, init_x, init_y):
+        """Place the given cars (indices or a mask) standing at the given pose."""
+        self.position[cars] = np.stack([init_x, init_y], axis=-1)
+        self.angle[cars] = init_angle
+        for array in [self.speed, self.angular_velocity, self.steering, self.target_steering,
+                      self.wheel_gas, self.wheel_brake, self.omega, self.phase]:
+            array[cars] = 0
+
+    def steer(self, s):
+        self.target_steering[:] = s
+
+    def gas(self, gas):
+        gas = np.minimum(np.maximum(gas, 0), 1)
+        self.wheel_gas += np.minimum(gas - self.wheel_gas, 0.1)  # gradually increase, but stop immediately
+
+    def brake(self, b):
+        self.wheel_brake[:] = b
+
+    def step(self, dt, on_road):
+        """Simulate `dt` seconds; `on_road` is a `[cars, 4]` mask of wheels on a road tile."""
+        self.steering += dt*np.minimum(np.maximum(50.0*(self.target_steering - self.steering), -3.0), 3.0)
+        np.minimum(np.maximum(self.steering, -0.4, out=self.steering), 0.4, out=self.steering)
+        friction_limit = np.where(on_road, FRICTION_LIMIT, FRICTION_LIMIT*0.6)
+
+        # Engine on the rear wheels, then brakes, as in `Car.step`
+        self.omega[:, 2:] += dt*ENGINE_POWER/WHEEL_MOMENT_OF_INERTIA*self.wheel_gas[:, np.newaxis]/(np.abs(self.omega[:, 2:]) + 5.0)
+        brake = self.wheel_brake[:, np.newaxis]
+        self.omega -= np.sign(self.omega)*np.minimum(15*brake, np.abs(self.omega))*(brake > 0)*(brake < 0.9)
+        self.omega *= brake < 0.9
+        self.phase += self.omega*dt
+
+        # Longitudinal traction of every wheel, front wheels pointing along the steering.
+        # Friction used for turning is not available for traction.
+        self._wheel_cos[:, :2] = np.cos(self.steering)[:, np.newaxis]
+        turn = np.abs(self.speed*self.angular_velocity)*(self.MASS/4)
+        traction_limit = np.sqrt(np.maximum(np.square(friction_limit) - np.square(turn)[:, np.newaxis], 0))
+        force = (self.omega*self.WHEEL_RAD - self.speed[:, np.newaxis]*self._wheel_cos)*self.TRACTION
+        force = np.minimum(np.maximum(force, -traction_limit), traction_limit)
+        self.omega -= dt*self.WHEEL_RAD/WHEEL_MOMENT_OF_INERTIA*force
+        self.speed += dt/self.MASS*np.sum(force*self._wheel_cos, axis=1)
+
+        # Turning without slip, limited by the total lateral friction
+        max_turn = np.sum(friction_limit, axis=1)/self.MASS/np.maximum(np.abs(self.speed), 1e-3)
+        self.angular_velocity = np.minimum(np.maximum(self.speed*np.tan(self.steering)/self.WHEELBASE, -max_turn), max_turn)
+        self.angle += dt*self.angular_velocity
+        self.position[:, 0] -= dt*self.speed*np.sin(self.angle)
+        self.position[:, 1] += dt*self.speed*np.cos(self.angle)
+
+    def velocity(self):
+        return self.speed[:, np.newaxis]*np.stack([-np.sin(self.angle), np.cos(self.angle)], axis=1)
+
+    def wheel_positions(self):
+        sin, cos = np.sin(self.angle)[:, np.newaxis], np.cos(self.angle)[:, np.newaxis]
+        wx, wy = np.array(WHEELPOS).T*SIZE
+        return self.position[:, np.newaxis] + np.stack([cos*wx - sin*wy, sin*wx + cos*wy], axis=2)
+
+class KinematicCar:
+    """Single `KinematicCars` car with the interface of `Car` used by `CarRacingCustomDraw`."""
+    class Body:
+        pass
+
+    def __init__(self, init_angle, init_x, init_y):
+        self.model = KinematicCars(1)
+        self.model.place(0, init_angle, init_x, init_y)
+        self.hull = KinematicCar.Body()
+        self.wheels = [KinematicCar.Body() for _ in WHEELPOS]
+        for w in self.wheels:
+            w.joint = KinematicCar.Body()
+            w.tiles = set()
+        self.fuel_spent = 0.0
+        self.particles = []
+        self._update_bodies()
+
+    def steer(self, s):
+        self.model.steer(s)
+
+    def gas(self, gas):
+        self.model.gas(gas)
+
+    def brake(self, b):
+        self.model.brake(b)
+
+    def step(self, dt):
+        self.model.step(dt, np.array([[bool(w.tiles) for w in self.wheels]]))
+        self._update_bodies()
+
+    def _update_bodies(self):
+        model = self.model
+        x, y = model.position[0].tolist()
+        angle, speed, steering = model.angle[0].item(), model.speed[0].item(), model.steering[0].item()
+        sin, cos = math.sin(angle), math.cos(angle)
+        self.hull.position = (x, y)
+        self.hull.angle = angle
+        self.hull.linearVelocity = (-speed*sin, speed*cos)
+        self.hull.angularVelocity = model.angular_velocity[0].item()
+        for i, (w, (wx, wy), omega, phase) in enumerate(zip(self.wheels, WHEELPOS, model.omega[0].tolist(), model.phase[0].tolist())):
+            w.position = (x + (cos*wx - sin*wy)*SIZE, y + (sin*wx + cos*wy)*SIZE)
+            w.joint.angle = steering if i < 2 else 0.0
+            w.angle = angle + w.joint.angle
+            w.omega = omega
+            w.phase = phase
+
+    def draw(self, viewer, draw_particles=True):
+        # Same polygons as drawn by `Car.draw` for the Box2D bodies
+        def transform(polygon, x, y, angle):
+            sin, cos = math.sin(angle), math.cos(angle)
+            return [(x + cos*px - sin*py, y + sin*px + cos*py) for px, py in polygon]
+
+        for w in self.wheels:
+            polygon = [(-WHEEL_W*SIZE, +WHEEL_R*SIZE), (+WHEEL_W*SIZE, +WHEEL_R*SIZE),
+                       (+WHEEL_W*SIZE, -WHEEL_R*SIZE), (-WHEEL_W*SIZE, -WHEEL_R*SIZE)]
+            viewer.draw_polygon(transform(polygon, *w.position, w.angle), color=WHEEL_COLOR)
+            a1, a2 = w.phase, w.phase + 1.2
+            s1, s2, c1, c2 = math.sin(a1), math.sin(a2), math.cos(a1), math.cos(a2)
+            if s1>0 and s2>0: continue
+            if s1>0: c1 = np.sign(c1)
+            if s2>0: c2 = np.sign(c2)
+            white_poly = [
+                (-WHEEL_W*SIZE, +WHEEL_R*c1*SIZE), (+WHEEL_W*SIZE, +WHEEL_R*c1*SIZE),
+                (+WHEEL_W*SIZE, +WHEEL_R*c2*SIZE), (-WHEEL_W*SIZE, +WHEEL_R*c2*SIZE)
+                ]
+            viewer.draw_polygon(transform(white_poly, *w.position, w.angle), color=WHEEL_WHITE)
+        for polygon in [HULL_POLY1, HULL_POLY2, HULL_POLY3, HULL_POLY4]:
+            viewer.draw_polygon(transform([(x*SIZE, y*SIZE) for x, y in polygon], *self.hull.position, self.hull.angle),
+                                color=(0.8,0.0,0.0))
+
+    def destroy(self):
+        pass
+
 #####################################
 # Modified version of car_racing.py #
 #####################################
@@ -290,6 +450,7 @@ class Car:
 STATE_W = 96
 STATE_H = 96
 RENDER_UPSCALE = 6
+GRAYSCALE = [0.2989, 0.5870, 0.1140]  # Same weights as tf.image.rgb_to_grayscale
 
 SCALE       = 6.0        # Track scale
 TRACK_RAD   = 900/SCALE  # Track is heavily morphed circle with this radius
@@ -304,17 +465,315 @@ TRACK_TURN_RATE = 0.31
 TRACK_WIDTH = 40/SCALE
 BORDER = 8/SCALE
 BORDER_MIN_COUNT = 4
+TILE_GRID_CELL = TRACK_WIDTH  # Cell size of the grid used by geometric tile tracking
 
 ROAD_COLOR = [0.4, 0.4, 0.4]
 
+# Physics fidelity profiles: (substeps per frame, velocity iterations, position iterations)
+PHYSICS_PROFILES = {
+    "reference": (1, 6*30, 2*30),  # The original CarRacing settings
+    "medium": (1, 30, 10),
+    "box2d": (1, 8, 3),            # Box2D recommended defaults
+    "box2d_substeps": (2, 8, 3),
+    "fast": (1, 3, 1),
+}
+
+def generate_track(np_random):
+    """Generate track geometry using the given random generator.
+
+    Returns a pair `(track, border)`, where `track` is a list of `(alpha, beta, x, y)`
+    tuples, one per tile, and `border` marks tiles with a red-white border, or `None`
+    when the generated track could not be closed.
+    """
+    CHECKPOINTS = 12
+
+    # Create checkpoints
+    checkpoints = []
+    for c in range(CHECKPOINTS):
+        alpha = 2*math.pi*c/CHECKPOINTS + np_random.uniform(0, 2*math.pi*1/CHECKPOINTS)
+        rad = np_random.uniform(TRACK_RAD/3, TRACK_RAD)
+        if c==0:
+            alpha = 0
+            rad = 1.5*TRACK_RAD
+        if c==CHECKPOINTS-1:
+            alpha = 2*math.pi*c/CHECKPOINTS
+            start_alpha = 2*math.pi*(-0.5)/CHECKPOINTS
+            rad = 1.5*TRACK_RAD
+        checkpoints.append( (alpha, rad*math.cos(alpha), rad*math.sin(alpha)) )
+
+    #print "\n".join(str(h) for h in checkpoints)
+
+    # Go from one checkpoint to another to create track
+    x, y, beta = 1.5*TRACK_RAD, 0, 0
+    dest_i = 0
+    laps = 0
+    track = []
+    no_freeze = 2500
+    visited_other_side = False
+    while 1:
+        alpha = math.atan2(y, x)
+        if visited_other_side and alpha > 0:
+            laps += 1
+            visited_other_side = False
+        if alpha < 0:
+            visited_other_side = True
+            alpha += 2*math.pi
+        while True: # Find destination from checkpoints
+            failed = True
+            while True:
+                dest_alpha, dest_x, dest_y = checkpoints[dest_i % len(checkpoints)]
+                if alpha <= dest_alpha:
+                    failed = False
+                    break
+                dest_i += 1
+                if dest_i % len(checkpoints) == 0: break
+            if not failed: break
+            alpha -= 2*math.pi
+            continue
+        r1x = math.cos(beta)
+        r1y = math.sin(beta)
+        p1x = -r1y
+        p1y = r1x
+        dest_dx = dest_x - x  # vector towards destination
+        dest_dy = dest_y - y
+        proj = r1x*dest_dx + r1y*dest_dy  # destination vector projected on rad
+        while beta - alpha >  1.5*math.pi: beta -= 2*math.pi
+        while beta - alpha < -1.5*math.pi: beta += 2*math.pi
+        prev_beta = beta
+        proj *= SCALE
+        if proj >  0.3: beta -= min(TRACK_TURN_RATE, abs(0.001*proj))
+        if proj < -0.3: beta += min(TRACK_TURN_RATE, abs(0.001*proj))
+        x += p1x*TRACK_DETAIL_STEP
+        y += p1y*TRACK_DETAIL_STEP
+        track.append( (alpha,prev_beta*0.5 + beta*0.5,x,y) )
+        if laps > 4: break
+        no_freeze -= 1
+        if no_freeze==0: break
+    #print "\n".join([str(t) for t in enumerate(track)])
+
+    # Find closed loop range i1..i2, first loop should be ignored, second is OK
+    i1, i2 = -1, -1
+    i = len(track)
+    while True:
+        i -= 1
+        if i==0: return None  # Failed
+        pass_through_start = track[i][0] > start_alpha and track[i-1][0] <= start_alpha
+        if pass_through_start and i2==-1:
+            i2 = i
+        elif pass_through_start and i1==-1:
+            i1 = i
+            break
+    print("Track generation: %i..%i -> %i-tiles track" % (i1, i2, i2-i1))
+    assert i1!=-1
+    assert i2!=-1
+
+    track = track[i1:i2-1]
+
+    first_beta = track[0][1]
+    first_perp_x = math.cos(first_beta)
+    first_perp_y = math.sin(first_beta)
+    # Length of perpendicular jump to put together head and tail
+    well_glued_together = np.sqrt(
+        np.square( first_perp_x*(track[0][2] - track[-1][2]) ) +
+        np.square( first_perp_y*(track[0][3] - track[-1][3]) ))
+    if well_glued_together > TRACK_DETAIL_STEP:
+        return None
+
+    # Red-white border on hard turns
+    border = [False]*len(track)
+    for i in range(len(track)):
+        good = True
+        oneside = 0
+        for neg in range(BORDER_MIN_COUNT):
+            beta1 = track[i-neg-0][1]
+            beta2 = track[i-neg-1][1]
+            good &= abs(beta1 - beta2) > TRACK_TURN_RATE*0.2
+            oneside += np.sign(beta1 - beta2)
+        good &= abs(oneside) == BORDER_MIN_COUNT
+        border[i] = good
+    for i in range(len(track)):
+        for neg in range(BORDER_MIN_COUNT):
+            border[i-neg] |= border[i]
+
+    return track, border
+
+def generate_track_until_valid(np_random):
+    """Generate tracks with the given random generator until one succeeds, returning it."""
+    while True:
+        geometry = generate_track(np_random)
+        if geometry is not None: return geometry
+        print("retry to generate track (normal if there are not many of this messages)")
+
+def generate_track_for_seed(seed):
+    """Generate the track the environment creates on the first reset after `seed(seed)`."""
+    np_random, _ = seeding.np_random(seed)
+    return generate_track_until_valid(np_random)
+
+class TrackLibrary:
+    """Precomputed tracks keyed by seed, stored as memory-mapped NumPy arrays.
+
+    The library is a directory containing `seeds.npy` with the seed of every track,
+    `offsets.npy` with the start of every track in `tracks.npy`, and `tracks.npy`
+    with one `(alpha, beta, x, y, border)` row per tile. Tile vertices and colors
+    are derived from these rows exactly as during generation.
+    """
+    def __init__(self, path):
+        self.seeds = np.load(os.path.join(path, "seeds.npy"))
+        self._offsets = np.load(os.path.join(path, "offsets.npy"))
+        self._tracks = np.load(os.path.join(path, "tracks.npy"), mmap_mode="r")
+        self._index = {seed: i for i, seed in enumerate(self.seeds.tolist())}
+
+    def __len__(self):
+        return len(self.seeds)
+
+    def index(self, seed):
+        return self._index[seed]
+
+    def track(self, index):
+        rows = self._tracks[self._offsets[index]:self._offsets[index + 1]]
+        return [tuple(row) for row in rows[:, :4].tolist()], rows[:, 4].astype(np.bool).tolist()
+
+    @staticmethod
+    def create(path, seeds):
+        seeds = list(seeds)
+        offsets, tracks = [0], []
+        for seed in seeds:
+            track, border = generate_track_for_seed(seed)
+            tracks.append(np.concatenate([np.array(track, dtype=np.float64),
+                                          np.array(border, dtype=np.float64)[:, np.newaxis]], axis=1))
+            offsets.append(offsets[-1] + len(track))
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "seeds.npy"), np.array(seeds, dtype=np.int64))
+        np.save(os.path.join(path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(path, "tracks.npy"), np.concatenate(tracks, axis=0))
+        return TrackLibrary(path)
+
+class TrackPrefetcher:
+    """Generates geometry of the upcoming tracks in a background process.
+
+    At most `tracks` generated tracks are kept ready; the worker blocks
+    until one of them is consumed by `track()`.
+    """
+    def __init__(self, tracks, seed):
+        import atexit
+        import multiprocessing
+
+        self.tracks = tracks
+        self._queue = multiprocessing.Queue(maxsize=tracks)
+        self._process = multiprocessing.Process(target=TrackPrefetcher._worker, args=(seed, self._queue), daemon=True)
+        self._process.start()
+        atexit.register(self.close)
+
+    def track(self):
+        """Return `(seed, (track, border))` of the next track."""
+        import queue
+
+        while True:
+            if self._process is None or not self._process.is_alive():
+                raise RuntimeError("The track prefetching process is not running")
+            try:
+                return self._queue.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    def close(self):
+        import atexit
+
+        if self._process is not None:
+            self._process.terminate()
+            self._process = None
+            atexit.unregister(self.close)
+
+    @staticmethod
+    def _worker(seed, queue):
+        np_random, _ = seeding.np_random(seed)
+        try:
+            while True:
+                # Every track has its own seed, so that it can be logged and regenerated
+                track_seed = np_random.randint(2**31)
+                queue.put((track_seed, generate_track_for_seed(track_seed)))
+        except KeyboardInterrupt:
+            pass
+
+class EpisodeLog:
+    """Compact record of a CarRacing episode, sufficient to re-simulate it.
+
+    Stores the track seed, or for tracks generated by the environment random generator
+    its `track_state` before the generation, and for every step its action and frame_skip. Actions are
+    stored as indices into a table of distinct actions, so a policy choosing from
+    a few discrete actions needs just a few bytes per step. The actions are kept
+    as float64 whatever their original dtype, so they are replayed exactly. The
+    `config` contains the constructor arguments of the logging environment.
+    """
+    def __init__(self, track_seed, actions=None, action_indices=(), frame_skips=(), config=None, track_state=None):
+        self.track_seed = track_seed
+        self.track_state = track_state
+        self.config = config
+        self._actions = collections.OrderedDict()
+        if actions is not None:
+            for action in np.asarray(actions, dtype=np.float64): self._actions[action.tobytes()] = len(self._actions)
+        self.action_indices = list(action_indices)
+        self.frame_skips = list(frame_skips)
+
+    def __len__(self):
+        return len(self.action_indices)
+
+    def append(self, action, frame_skip):
+        action = np.asarray(action, dtype=np.float64)
+        index = self._actions.setdefault(action.tobytes(), len(self._actions))
+        self.action_indices.append(index)
+        self.frame_skips.append(frame_skip)
+
+    def actions(self):
+        """Return the table of distinct actions, indexed by `action_indices`."""
+        if not self._actions: return np.zeros([0, 3])
+        return np.frombuffer(b"".join(self._actions), dtype=np.float64).reshape([len(self._actions), -1])
+
+    def save(self, path):
+        # The MT19937 generator state is stored as its keys and the remaining scalars
+        track_state = {} if self.track_state is None else {
+            "track_state_keys": self.track_state[1], "track_state_rest": np.array(self.track_state[2:], dtype=np.float64)}
+        np.savez_compressed(path, track_seed=-1 if self.track_seed is None else self.track_seed, actions=self.actions(),
+                            action_indices=np.array(self.action_indices, dtype=np.uint32 if len(self._actions) > 65536 else np.uint16),
+                            frame_skips=np.array(self.frame_skips, dtype=np.uint16), config=json.dumps(self.config), **track_state)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as log:
+            config = json.loads(str(log["config"])) if "config" in log else None
+            track_seed, track_state = int(log["track_seed"]), None
+            if "track_state_keys" in log:
+                pos, has_gauss, cached_gaussian = log["track_state_rest"].tolist()
+                track_seed, track_state = None, ("MT19937", log["track_state_keys"], int(pos), int(has_gauss), cached_gaussian)
+            return EpisodeLog(track_seed, log["actions"], log["action_indices"].tolist(), log["frame_skips"].tolist(),
+                              config, track_state)
+
+class Profiler:
+    """Accumulated wall time and number of calls of individual simulation phases."""
+    def __init__(self):
+        self.time = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+
+    def add(self, phase, start):
+        self.time[phase] += time.perf_counter() - start
+        self.calls[phase] += 1
+
+    def stats(self):
+        return {phase: {"time": self.time[phase], "calls": self.calls[phase]} for phase in self.time}
+
 class FrictionDetector(contactListener):
     def __init__(self, env):
         contactListener.__init__(self)
         self.env = env
     def BeginContact(self, contact):
+        if self.env.profiler: start = time.perf_counter()
         self._contact(contact, True)
+        if self.env.profiler: self.env.profiler.add("contacts", start)
     def EndContact(self, contact):
+        if self.env.profiler: start = time.perf_counter()
         self._contact(contact, False)
+        if self.env.profiler: self.env.profiler.add("contacts", start)
     def _contact(self, contact, begin):
         tile = None
         obj = None
@@ -327,10 +786,13 @@ class FrictionDetector(contactListener):
             tile = u2
             obj  = u1
         if not tile: return
+        self.tile_contact(tile, obj, begin)
 
-        tile.color[0] = ROAD_COLOR[0]
-        tile.color[1] = ROAD_COLOR[1]
-        tile.color[2] = ROAD_COLOR[2]
+    def tile_contact(self, tile, obj, begin):
+        if not self.env.headless:
+            tile.color[0] = ROAD_COLOR[0]
+            tile.color[1] = ROAD_COLOR[1]
+            tile.color[2] = ROAD_COLOR[2]
         if not obj or "tiles" not in obj.__dict__: return
         if begin:
             obj.tiles.add(tile)
@@ -343,6 +805,10 @@ class FrictionDetector(contactListener):
             obj.tiles.remove(tile)
             #print tile.road_friction, "DEL", len(obj.tiles) -- should delete to zero when on grass (this works)
 
+class Tile:
+    """Road tile without a Box2D body, used by the geometric tile tracking."""
+    pass
+
 class CarRacingCustomDraw(gym.Env):
     metadata = {
         'render.modes': ['human'],
@@ -358,7 +824,12 @@ class CarRacingCustomDraw(gym.Env):
     color_abs_light = np.array([0., 0., 1.])
     color_abs_dark = np.array([0.2, 0., 1.])
 
-    def __init__(self):
+    def __init__(self, width=STATE_W, height=STATE_H, grayscale=False, observation="pixels", vector_tiles=10,
+                 tile_tracking="contacts", physics="reference", headless=False, backend="box2d"):
+        # The constructor arguments, recorded in episode logs
+        self.config = dict(width=width, height=height, grayscale=grayscale, observation=observation,
+                           vector_tiles=vector_tiles, tile_tracking=tile_tracking, physics=physics,
+                           headless=headless, backend=backend)
         self._seed()
         self.contactListener_keepref = FrictionDetector(self)
         self.world = Box2D.b2World((0,0), contactListener=self.contactListener_keepref)
@@ -369,136 +840,189 @@ class CarRacingCustomDraw(gym.Env):
         self.car = None
         self.reward = 0.0
         self.prev_reward = 0.0
-        self.state = np.zeros([STATE_H, STATE_W, 3], dtype=np.float32)
+        if observation == "pixels":
+            self.state = np.zeros([height, width, 1 if grayscale else 3], dtype=np.float32)
+            self.observation_space = spaces.Box(low=0, high=255, shape=self.state.shape)
+        elif observation == "vector":
+            # Hull position, angle, velocity and angular velocity, wheel omegas, steering angle
+            # and positions of the following `vector_tiles` track tiles relative to the car.
+            self.state = np.zeros([11 + 2 * vector_tiles], dtype=np.float32)
+            self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=self.state.shape)
+        else:
+            raise ValueError("Unknown CarRacing observation type '{}'".format(observation))
+        self.observation, self.vector_tiles = observation, vector_tiles
+        # Tiles visited by the wheels are either reported by Box2D sensor contacts,
+        # or found geometrically by looking up the wheel centers in a grid of tile polygons.
+        if tile_tracking not in ["contacts", "geometric"]:
+            raise ValueError("Unknown CarRacing tile tracking '{}'".format(tile_tracking))
+        # The car is simulated either by Box2D, or by the `KinematicCars` surrogate,
+        # which has no bodies and therefore always uses geometric tile tracking.
+        if backend not in ["box2d", "kinematic"]:
+            raise ValueError("Unknown CarRacing backend '{}'".format(backend))
+        self.backend = backend
+        self.tile_tracking = "geometric" if backend == "kinematic" else tile_tracking
+        if physics not in PHYSICS_PROFILES:
+            raise ValueError("Unknown CarRacing physics profile '{}'".format(physics))
+        self.physics = physics
+        # In headless mode, purely cosmetic state is not simulated: skid particles,
+        # recoloring of visited tiles (so the road keeps its shades) and fuel accounting.
+        self.headless = headless
+        self.canvas = None
         self.action_space = spaces.Box( np.array([-1,0,0]), np.array([+1,+1,+1]))  # steer, gas, brake
-        self.observation_space = spaces.Box(low=0, high=255, shape=(STATE_H, STATE_W, 3))
         self.frame_skip = 1
+        self.track_library = None
+        self.track_library_next = None
+        self.track_prefetcher = None
+        self.track_pool = None
+        self.tile_grid = None
+        self.profiler = None
+        self.episode_logging = False
+        self.episode_log = None
+        self.episode_log_directory = None
+        self.episode_log_index = 0
+
+    def enable_profiling(self, enable=True):
+        """Measure time spent in individual phases of every step.
+
+        The cumulative statistics are returned by `profile_stats()` and also in the `info`
+        of every `step`. The phases are `car_step`, `world_step` (which includes
+        `contacts`, the time spent in the FrictionDetector callbacks), `tile_tracking`
+        (only with geometric tile tracking), `render_road`,
+        `draw_car`, `render_indicators` and `state_vector`.
+        """
+        self.profiler = Profiler() if enable else None
+
+    def profile_stats(self, reset=False):
+        stats = self.profiler.stats() if self.profiler else {}
+        if reset and self.profiler: self.profiler = Profiler()
+        return stats
+
+    def use_track_library(self, library, sequential=False):
+        """Load tracks from the given `TrackLibrary` instead of generating them.
+
+        The tracks are chosen randomly, or in library order when `sequential` is set.
+        """
+        self.track_library = library
+        self.track_library_next = 0 if sequential else None
+
+    def use_track_prefetcher(self, tracks):
+        """Generate the next `tracks` tracks in a background process while episodes run."""
+        if self.track_prefetcher is not None:
+            self.track_prefetcher.close()
+        self.track_prefetcher = TrackPrefetcher(tracks, self.np_random.randint(2**31)) if tracks else None
+
+    def use_track_pool(self, size):
+        """Keep the tiles of the last `size` distinct tracks between episodes.
+
+        Resetting to a pooled track then only resets the visited flags and colors of its
+        tiles and places a new car, instead of creating all the tile bodies again.
+        Tiles of the pooled tracks not currently used are inactive in the world.
+        """
+        if self.track_pool is not None:
+            while self.track_pool:
+                self._destroy_pooled_track(self.track_pool.popitem(last=False)[1])
+        self.track_pool = collections.OrderedDict() if size else None
+        self.track_pool_size = size
+
+    def _destroy_pooled_track(self, pooled):
+        road = pooled[0]
+        if road is self.road: return
+        if self.tile_tracking == "contacts":
+            for t in road:
+                self.world.DestroyBody(t)
+
+    def log_episodes(self, enable=True, directory=None):
+        """Record every episode into an `EpisodeLog`, available as `episode_log`.
+
+        If a `directory` is given, the log of every episode is saved into it as
+        `episode-NNNNNN.npz` when the episode ends. Tracks are generated exactly as
+        without logging; the log then keeps the state of the random generator
+        the track was generated by.
+        """
+        self.episode_logging = enable
+        self.episode_log = None
+        self.episode_log_directory = directory if enable else None
+        self.episode_log_index = 0
+        if self.episode_log_directory is not None:
+            os.makedirs(self.episode_log_directory, exist_ok=True)
+
+    def replay(self, log, steps=None):
+        """Deterministically re-simulate a logged episode, ending the current one.
+
+        Yields `(step, state, reward, done)` for every step, with step 0 being the
+        initial observation after reset. If `steps` (a range or a set) is given,
+        only these steps are observed (rendered) and yielded. The environment must
+        have been created with the `config` of the log, for example by
+        `CarRacingCustomDraw(**log.config)`.
+        """
+        if log.config is not None and log.config != self.config:
+            raise ValueError("The episode was logged by an environment with different arguments: {}".format(
+                {key: value for key, value in log.config.items() if self.config.get(key) != value}))
+        logging, self.episode_logging = self.episode_logging, False
+        try:
+            self._start_episode(track_seed=log.track_seed, track_state=log.track_state)
+            self._simulate(None)
+            if steps is None or 0 in steps:
+                self._observe()
+                yield 0, np.copy(self.state), 0.0, False
+            actions = log.actions()
+            for step, (index, frame_skip) in enumerate(zip(log.action_indices, log.frame_skips), 1):
+                self.frame_skip = frame_skip
+                reward, done = self._simulate(actions[index])
+                if steps is None or step in steps:
+                    self._observe()
+                    yield step, np.copy(self.state), reward, done
+        finally:
+            self.episode_logging = logging
+
+    def _close(self):
+        if self.track_prefetcher is not None:
+            self.track_prefetcher.close()
+            self.track_prefetcher = None
 
     def _seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
+        # The prefetched tracks come from the previous seed, so restart the prefetcher
+        if getattr(self, "track_prefetcher", None) is not None:
+            self.use_track_prefetcher(self.track_prefetcher.tracks)
         return [seed]
 
     def _destroy(self):
         if not self.road: return
-        for t in self.road:
-            self.world.DestroyBody(t)
+        if self.tile_tracking == "contacts":
+            pooled = self.track_pool is not None and any(self.road is road for road, *_ in self.track_pool.values())
+            for t in self.road:
+                if pooled:
+                    t.active = False
+                else:
+                    self.world.DestroyBody(t)
         self.road = []
         self.car.destroy()
 
-    def _create_track(self):
-        CHECKPOINTS = 12
-
-        # Create checkpoints
-        checkpoints = []
-        for c in range(CHECKPOINTS):
-            alpha = 2*math.pi*c/CHECKPOINTS + self.np_random.uniform(0, 2*math.pi*1/CHECKPOINTS)
-            rad = self.np_random.uniform(TRACK_RAD/3, TRACK_RAD)
-            if c==0:
-                alpha = 0
-                rad = 1.5*TRACK_RAD
-            if c==CHECKPOINTS-1:
-                alpha = 2*math.pi*c/CHECKPOINTS
-                self.start_alpha = 2*math.pi*(-0.5)/CHECKPOINTS
-                rad = 1.5*TRACK_RAD
-            checkpoints.append( (alpha, rad*math.cos(alpha), rad*math.sin(alpha)) )
-
-        #print "\n".join(str(h) for h in checkpoints)
-        #self.road_poly = [ (    # uncomment this to see checkpoints
-        #    [ (tx,ty) for a,tx,ty in checkpoints ],
-        #    (0.7,0.7,0.9) ) ]
-        self.road = []
+    def _load_track(self, track, border):
+        if self.track_pool is None:
+            self._build_track(track, border)
+            return
 
-        # Go from one checkpoint to another to create track
-        x, y, beta = 1.5*TRACK_RAD, 0, 0
-        dest_i = 0
-        laps = 0
-        track = []
-        no_freeze = 2500
-        visited_other_side = False
-        while 1:
-            alpha = math.atan2(y, x)
-            if visited_other_side and alpha > 0:
-                laps += 1
-                visited_other_side = False
-            if alpha < 0:
-                visited_other_side = True
-                alpha += 2*math.pi
-            while True: # Find destination from checkpoints
-                failed = True
-                while True:
-                    dest_alpha, dest_x, dest_y = checkpoints[dest_i % len(checkpoints)]
-                    if alpha <= dest_alpha:
-                        failed = False
-                        break
-                    dest_i += 1
-                    if dest_i % len(checkpoints) == 0: break
-                if not failed: break
-                alpha -= 2*math.pi
-                continue
-            r1x = math.cos(beta)
-            r1y = math.sin(beta)
-            p1x = -r1y
-            p1y = r1x
-            dest_dx = dest_x - x  # vector towards destination
-            dest_dy = dest_y - y
-            proj = r1x*dest_dx + r1y*dest_dy  # destination vector projected on rad
-            while beta - alpha >  1.5*math.pi: beta -= 2*math.pi
-            while beta - alpha < -1.5*math.pi: beta += 2*math.pi
-            prev_beta = beta
-            proj *= SCALE
-            if proj >  0.3: beta -= min(TRACK_TURN_RATE, abs(0.001*proj))
-            if proj < -0.3: beta += min(TRACK_TURN_RATE, abs(0.001*proj))
-            x += p1x*TRACK_DETAIL_STEP
-            y += p1y*TRACK_DETAIL_STEP
-            track.append( (alpha,prev_beta*0.5 + beta*0.5,x,y) )
-            if laps > 4: break
-            no_freeze -= 1
-            if no_freeze==0: break
-        #print "\n".join([str(t) for t in enumerate(track)])
-
-        # Find closed loop range i1..i2, first loop should be ignored, second is OK
-        i1, i2 = -1, -1
-        i = len(track)
-        while True:
-            i -= 1
-            if i==0: return False  # Failed
-            pass_through_start = track[i][0] > self.start_alpha and track[i-1][0] <= self.start_alpha
-            if pass_through_start and i2==-1:
-                i2 = i
-            elif pass_through_start and i1==-1:
-                i1 = i
-                break
-        print("Track generation: %i..%i -> %i-tiles track" % (i1, i2, i2-i1))
-        assert i1!=-1
-        assert i2!=-1
-
-        track = track[i1:i2-1]
-
-        first_beta = track[0][1]
-        first_perp_x = math.cos(first_beta)
-        first_perp_y = math.sin(first_beta)
-        # Length of perpendicular jump to put together head and tail
-        well_glued_together = np.sqrt(
-            np.square( first_perp_x*(track[0][2] - track[-1][2]) ) +
-            np.square( first_perp_y*(track[0][3] - track[-1][3]) ))
-        if well_glued_together > TRACK_DETAIL_STEP:
-            return False
-
-        # Red-white border on hard turns
-        border = [False]*len(track)
-        for i in range(len(track)):
-            good = True
-            oneside = 0
-            for neg in range(BORDER_MIN_COUNT):
-                beta1 = track[i-neg-0][1]
-                beta2 = track[i-neg-1][1]
-                good &= abs(beta1 - beta2) > TRACK_TURN_RATE*0.2
-                oneside += np.sign(beta1 - beta2)
-            good &= abs(oneside) == BORDER_MIN_COUNT
-            border[i] = good
-        for i in range(len(track)):
-            for neg in range(BORDER_MIN_COUNT):
-                border[i-neg] |= border[i]
+        key = np.asarray(track).tobytes() + np.asarray(border).tobytes()
+        if key in self.track_pool:
+            self.track_pool.move_to_end(key)
+            self.road, self.road_poly, self.track, self.track_xy, self.tile_grid = self.track_pool[key]
+            for i, t in enumerate(self.road):
+                c = 0.01*(i%3)
+                t.color[:] = [ROAD_COLOR[0] + c, ROAD_COLOR[1] + c, ROAD_COLOR[2] + c]
+                t.road_visited = False
+                if self.tile_tracking == "contacts":
+                    t.active = True
+        else:
+            self._build_track(track, border)
+            self.track_pool[key] = (self.road, self.road_poly, self.track, self.track_xy, self.tile_grid)
+            if len(self.track_pool) > self.track_pool_size:
+                self._destroy_pooled_track(self.track_pool.popitem(last=False)[1])
+
+    def _build_track(self, track, border):
+        self.road = []
+        polygons = []
 
         # Create tiles
         for i in range(len(track)):
@@ -508,17 +1032,21 @@ class CarRacingCustomDraw(gym.Env):
             road1_r = (x1 + TRACK_WIDTH*math.cos(beta1), y1 + TRACK_WIDTH*math.sin(beta1))
             road2_l = (x2 - TRACK_WIDTH*math.cos(beta2), y2 - TRACK_WIDTH*math.sin(beta2))
             road2_r = (x2 + TRACK_WIDTH*math.cos(beta2), y2 + TRACK_WIDTH*math.sin(beta2))
-            t = self.world.CreateStaticBody( fixtures = fixtureDef(
-                shape=polygonShape(vertices=[road1_l, road1_r, road2_r, road2_l])
-                ))
-            t.userData = t
+            if self.tile_tracking == "contacts":
+                t = self.world.CreateStaticBody( fixtures = fixtureDef(
+                    shape=polygonShape(vertices=[road1_l, road1_r, road2_r, road2_l])
+                    ))
+                t.userData = t
+                t.fixtures[0].sensor = True
+            else:
+                t = Tile()
             c = 0.01*(i%3)
             t.color = [ROAD_COLOR[0] + c, ROAD_COLOR[1] + c, ROAD_COLOR[2] + c]
             t.road_visited = False
             t.road_friction = 1.0
-            t.fixtures[0].sensor = True
             self.road_poly.append(( [road1_l, road1_r, road2_r, road2_l], t.color ))
             self.road.append(t)
+            polygons.append([road1_l, road1_r, road2_r, road2_l])
             if border[i]:
                 side = np.sign(beta2 - beta1)
                 b1_l = (x1 + side* TRACK_WIDTH        *math.cos(beta1), y1 + side* TRACK_WIDTH        *math.sin(beta1))
@@ -527,9 +1055,49 @@ class CarRacingCustomDraw(gym.Env):
                 b2_r = (x2 + side*(TRACK_WIDTH+BORDER)*math.cos(beta2), y2 + side*(TRACK_WIDTH+BORDER)*math.sin(beta2))
                 self.road_poly.append(( [b1_l, b1_r, b2_r, b2_l], self.color_white if i%2==0 else self.color_red ))
         self.track = track
-        return True
+        self.track_xy = np.array([(x, y) for _, _, x, y in track])
+        if self.tile_tracking == "geometric":
+            self._build_tile_grid(polygons)
+
+    def _build_tile_grid(self, polygons):
+        # Every tile is stored as the half-planes `nx * x + ny * y <= offset` of its edges,
+        # with the normals oriented outwards regardless of the polygon winding, in all
+        # cells of a uniform grid its bounding box overlaps.
+        self.tile_grid = collections.defaultdict(list)
+        for i, polygon in enumerate(polygons):
+            edges = list(zip(polygon, polygon[1:] + polygon[:1]))
+            orientation = 1 if sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in edges) >= 0 else -1
+            halfplanes = []
+            for (x1, y1), (x2, y2) in edges:
+                nx, ny = orientation * (y2 - y1), orientation * (x1 - x2)
+                halfplanes.append((nx, ny, nx * x1 + ny * y1))
+            xs, ys = [x for x, _ in polygon], [y for _, y in polygon]
+            for cx in range(int(math.floor(min(xs) / TILE_GRID_CELL)), int(math.floor(max(xs) / TILE_GRID_CELL)) + 1):
+                for cy in range(int(math.floor(min(ys) / TILE_GRID_CELL)), int(math.floor(max(ys) / TILE_GRID_CELL)) + 1):
+                    self.tile_grid[cx, cy].append((self.road[i], halfplanes))
+
+    def _find_tile(self, x, y):
+        """Return the tile containing the given point, or None if it is on grass."""
+        for tile, halfplanes in self.tile_grid.get((int(math.floor(x / TILE_GRID_CELL)), int(math.floor(y / TILE_GRID_CELL))), ()):
+            if all(nx * x + ny * y <= offset for nx, ny, offset in halfplanes):
+                return tile
+        return None
+
+    def _track_tiles(self):
+        # Geometric counterpart of the FrictionDetector: a wheel is on the tile containing its center.
+        for w in self.car.wheels:
+            tile = self._find_tile(*w.position)
+            if tile in w.tiles: continue
+            for previous in list(w.tiles):
+                self.contactListener_keepref.tile_contact(previous, w, False)
+            if tile is not None:
+                self.contactListener_keepref.tile_contact(tile, w, True)
 
     def _reset(self):
+        self._start_episode()
+        return self._step(None)[0]
+
+    def _start_episode(self, track_seed=None, track_state=None):
         self._destroy()
         self.reward = 0.0
         self.prev_reward = 0.0
@@ -540,15 +1108,50 @@ class CarRacingCustomDraw(gym.Env):
         self.frames = 0
         self.frame_skip = 1
 
-        while True:
-            success = self._create_track()
-            if success: break
-            print("retry to generate track (normal if there are not many of this messages)")
-        self.car = Car(self.world, *self.track[0][1:4])
-
-        return self._step(None)[0]
+        if track_seed is not None:
+            if self.track_library is not None and track_seed in self.track_library.seeds:
+                self._load_track(*self.track_library.track(self.track_library.index(track_seed)))
+            else:
+                self._load_track(*generate_track_for_seed(track_seed))
+        elif track_state is not None:
+            np_random = np.random.RandomState()
+            np_random.set_state(track_state)
+            self._load_track(*generate_track_until_valid(np_random))
+        elif self.track_library is not None:
+            if self.track_library_next is None:
+                index = self.np_random.randint(len(self.track_library))
+            else:
+                index = self.track_library_next
+                self.track_library_next = (index + 1) % len(self.track_library)
+            track_seed = int(self.track_library.seeds[index])
+            self._load_track(*self.track_library.track(index))
+        elif self.track_prefetcher is not None:
+            track_seed, geometry = self.track_prefetcher.track()
+            self._load_track(*geometry)
+        else:
+            if self.episode_logging:
+                track_state = self.np_random.get_state()
+            self._load_track(*generate_track_until_valid(self.np_random))
+        if self.episode_logging:
+            self.episode_log = EpisodeLog(track_seed, config=self.config, track_state=track_state)
+            self.episode_log_index += 1
+        else:
+            self.episode_log = None
+        if self.backend == "kinematic":
+            self.car = KinematicCar(*self.track[0][1:4])
+        else:
+            self.car = Car(self.world, *self.track[0][1:4], headless=self.headless)
 
     def _step(self, action):
+        total_reward, done = self._simulate(action)
+        if done and self.episode_log is not None and self.episode_log_directory is not None:
+            self.episode_log.save(os.path.join(self.episode_log_directory, "episode-{:06d}.npz".format(self.episode_log_index)))
+        self._observe()
+        return np.copy(self.state), total_reward, done, {"profile": self.profiler.stats()} if self.profiler else {}
+
+    def _simulate(self, action):
+        if self.episode_log is not None and action is not None:
+            self.episode_log.append(action, self.frame_skip)
         total_reward = 0
         for _ in range(max(self.frame_skip, 1)):
             if action is not None:
@@ -556,8 +1159,18 @@ class CarRacingCustomDraw(gym.Env):
                 self.car.gas(action[1])
                 self.car.brake(action[2])
 
-            self.car.step(1.0/FPS)
-            self.world.Step(1.0/FPS, 6*30, 2*30)
+            substeps, velocity_iterations, position_iterations = PHYSICS_PROFILES[self.physics]
+            for _ in range(substeps):
+                if self.profiler: start = time.perf_counter()
+                self.car.step(1.0/FPS/substeps)
+                if self.profiler: self.profiler.add("car_step", start); start = time.perf_counter()
+                if self.backend == "box2d":
+                    self.world.Step(1.0/FPS/substeps, velocity_iterations, position_iterations)
+                    if self.profiler: self.profiler.add("world_step", start)
+                if self.tile_tracking == "geometric":
+                    if self.profiler: start = time.perf_counter()
+                    self._track_tiles()
+                    if self.profiler: self.profiler.add("tile_tracking", start)
             self.t += 1.0/FPS
 
             step_reward = 0
@@ -581,8 +1194,7 @@ class CarRacingCustomDraw(gym.Env):
             if self.frames > 1000: done = True
             if done: break
 
-        self._draw()
-        return np.copy(self.state), total_reward, done, {}
+        return total_reward, done
 
     def _render(self, mode='human', close=False):
         if close:
@@ -595,9 +1207,41 @@ class CarRacingCustomDraw(gym.Env):
             from gym.envs.classic_control import rendering
             self.viewer = rendering.SimpleImageViewer()
 
-        self.viewer.imshow((self.state.repeat(RENDER_UPSCALE, axis=0).repeat(RENDER_UPSCALE, axis=1)*255).astype(np.uint8))
+        self.viewer.imshow(self.display_image())
 
-    def _draw(self):
+    def display_image(self, state=None):
+        """Return the given (or current) pixel state as an upscaled RGB uint8 image.
+
+        With vector observations, the current environment is drawn instead."""
+        image = self.state if state is None else state
+        if self.observation != "pixels":
+            image = np.zeros([STATE_H, STATE_W, 3], dtype=np.float32)
+            self._draw(image)
+        upscale = max(RENDER_UPSCALE * STATE_H // image.shape[0], 1)
+        return (image.repeat(upscale, axis=0).repeat(upscale, axis=1).repeat(3 // image.shape[2], axis=2)*255).astype(np.uint8)
+
+    def _observe(self):
+        if self.observation == "pixels":
+            self._draw(self.state)
+        else:
+            if self.profiler: start = time.perf_counter()
+            self._state_vector(self.state)
+            if self.profiler: self.profiler.add("state_vector", start)
+
+    def _state_vector(self, vector):
+        hull = self.car.hull
+        x, y = hull.position
+        vector[0:6] = [x, y, hull.angle, hull.linearVelocity[0], hull.linearVelocity[1], hull.angularVelocity]
+        vector[6:10] = [w.omega for w in self.car.wheels]
+        vector[10] = self.car.wheels[0].joint.angle
+
+        # Following tiles in the car coordinate system, the car heading along the y axis
+        nearest = np.argmin(np.sum(np.square(self.track_xy - (x, y)), axis=1))
+        tiles = self.track_xy[(nearest + 1 + np.arange(self.vector_tiles)) % len(self.track_xy)] - (x, y)
+        sin, cos = math.sin(hull.angle), math.cos(hull.angle)
+        vector[11:] = np.dot(tiles, [[cos, -sin], [sin, cos]]).ravel()
+
+    def _draw(self, canvas):
         # Simple 2D affine transformation class
         class Transform():
             def __init__(self, *values):
@@ -641,7 +1285,7 @@ class CarRacingCustomDraw(gym.Env):
             def __init__(self, env):
                 self.env = env
             def draw_polygon(self, path, color):
-                self.env._fill_polygon(path, self.env.state, color)
+                self.env._fill_polygon(path, self.env.canvas, color)
 
         if "t" not in self.__dict__: return  # reset() not called yet
 
@@ -652,19 +1296,25 @@ class CarRacingCustomDraw(gym.Env):
         vel = self.car.hull.linearVelocity
         if np.linalg.norm(vel) > 0.5:
             angle = math.atan2(vel[0], vel[1])
-        self.transform = Transform.translation(STATE_W/2, STATE_H*3/4)
-        self.transform *= Transform.scale(STATE_W/1000, STATE_H/1000)
+        height, width = canvas.shape[:2]
+        self.transform = Transform.translation(width/2, height*3/4)
+        self.transform *= Transform.scale(width/1000, height/1000)
         self.transform *= Transform.scale(zoom, -zoom)
         self.transform *= Transform.rotation(angle)
         self.transform *= Transform.translation(-scroll_x, -scroll_y)
 
         # Clear
-        self.state[:, :, :] = self.color_black
+        self.canvas = canvas
+        self.canvas[:, :, :] = 0
 
         # Draw road, car and indicators
+        if self.profiler: start = time.perf_counter()
         self._render_road(scroll_x, scroll_y, zoom)
+        if self.profiler: self.profiler.add("render_road", start); start = time.perf_counter()
         self.car.draw(Renderer(self), False)
+        if self.profiler: self.profiler.add("draw_car", start); start = time.perf_counter()
         self._render_indicators()
+        if self.profiler: self.profiler.add("render_indicators", start)
 
 
     def _render_road(self, scroll_x, scroll_y, zoom):
@@ -672,7 +1322,7 @@ class CarRacingCustomDraw(gym.Env):
             (-PLAYFIELD, +PLAYFIELD),
             (+PLAYFIELD, +PLAYFIELD),
             (+PLAYFIELD, -PLAYFIELD),
-            (-PLAYFIELD, -PLAYFIELD)], self.state, self.color_grass_dark)
+            (-PLAYFIELD, -PLAYFIELD)], self.canvas, self.color_grass_dark)
         k = PLAYFIELD/20.0
         mindist = 2000000 / (zoom ** 2)
         for x in range(-20, 20, 2):
@@ -686,26 +1336,27 @@ class CarRacingCustomDraw(gym.Env):
                     (kx + k, ky + 0),
                     (kx + 0, ky + 0),
                     (kx + 0, ky + k),
-                    (kx + k, ky + k)], self.state, self.color_grass_light)
+                    (kx + k, ky + k)], self.canvas, self.color_grass_light)
         for poly, color in self.road_poly:
             if (poly[0][0] - scroll_x) ** 2 + (poly[0][1] - scroll_y) ** 2 >= mindist: continue
-            self._fill_polygon(poly, self.state, color)
+            self._fill_polygon(poly, self.canvas, color)
 
     def _render_indicators(self):
-        s = STATE_W/40
-        h = STATE_H/40
-        self._fill_polygon([(0, STATE_H), (STATE_W, STATE_H), (STATE_W, STATE_H - 5*h), (0, STATE_H - 5*h)], self.state,
+        height, width = self.canvas.shape[:2]
+        s = width/40
+        h = height/40
+        self._fill_polygon([(0, height), (width, height), (width, height - 5*h), (0, height - 5*h)], self.canvas,
                            self.color_black, transform=False)
         def vertical_ind(place, val, color):
-            self._fill_polygon([((place+0)*s, STATE_H-h-h*val),
-                                ((place+2)*s, STATE_H-h-h*val),
-                                ((place+2)*s, STATE_H-h),
-                                ((place+0)*s, STATE_H-h)], self.state, color, transform=False)
+            self._fill_polygon([((place+0)*s, height-h-h*val),
+                                ((place+2)*s, height-h-h*val),
+                                ((place+2)*s, height-h),
+                                ((place+0)*s, height-h)], self.canvas, color, transform=False)
         def horiz_ind(place, val, color):
-            self._fill_polygon([((place+0)*s, STATE_H-4*h),
-                                ((place+val)*s, STATE_H-4*h),
-                                ((place+val)*s, STATE_H-1.5*h),
-                                ((place+0)*s, STATE_H-1.5*h)], self.state, color, transform=False)
+            self._fill_polygon([((place+0)*s, height-4*h),
+                                ((place+val)*s, height-4*h),
+                                ((place+val)*s, height-1.5*h),
+                                ((place+0)*s, height-1.5*h)], self.canvas, color, transform=False)
         true_speed = np.sqrt(np.square(self.car.hull.linearVelocity[0]) + np.square(self.car.hull.linearVelocity[1]))
         vertical_ind(1, 0.02*true_speed, self.color_white)
         vertical_ind(4, 0.01*self.car.wheels[0].omega, self.color_abs_light) # ABS sensors
@@ -744,6 +1395,7 @@ class CarRacingCustomDraw(gym.Env):
         if max_y <= 0: return
         if min(x for y,x in polygon) >= canvas.shape[1]: return
         if max(x for y,x in polygon) < 0: return
+        if canvas.shape[2] == 1: color = np.dot(GRAYSCALE, color)
         for y in range(min_y, max_y):
             nodes = []
             j = -1
@@ -760,6 +1412,178 @@ class CarRacingCustomDraw(gym.Env):
             for n,nn in zip(nodes[::2],nodes[1::2]):
                 canvas[y, max(int(n), 0):min(max(int(nn), 0), canvas.shape[1])] = color
 
+class CarRacingBatch:
+    """Several CarRacing environments simulated in a single process.
+
+    All observations are rendered into one preallocated `states` array of shape
+    `[environments] + observation shape`, which is overwritten by every `reset`
+    and `step`; copy it if the observations need to be kept.
+    """
+    def __init__(self, environments, seed=43, **kwargs):
+        self.envs = []
+        for i in range(environments):
+            env = CarRacingCustomDraw(**kwargs)
+            env.seed(seed + i)
+            self.envs.append(env)
+        self.states = np.zeros([environments] + list(self.envs[0].state.shape), dtype=np.float32)
+        for env, state in zip(self.envs, self.states):
+            env.state = state
+        self.rewards = np.zeros([environments], dtype=np.float32)
+        self.dones = np.zeros([environments], dtype=np.bool)
+
+    def __len__(self):
+        return len(self.envs)
+
+    def reset(self):
+        for env in self.envs:
+            self._reset_env(env)
+        return self.states
+
+    def step(self, actions, frame_skip=1):
+        """Step all environments, resetting the finished ones.
+
+        Returns `states`, `rewards` and `dones` arrays; for finished environments,
+        `states` contain the first observation of the next episode.
+        """
+        for i, (env, action) in enumerate(zip(self.envs, actions)):
+            env.frame_skip = frame_skip
+            self.rewards[i], self.dones[i] = env._simulate(action)
+            if self.dones[i]:
+                self._reset_env(env)
+            else:
+                env._observe()
+        return self.states, self.rewards, self.dones
+
+    def _reset_env(self, env):
+        env._start_episode()
+        env._simulate(None)
+        env._observe()
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+class KinematicCarRacingBatch:
+    """Many `KinematicCars` cars, each in its own episode on a common track.
+
+    Rewards and episode ends follow `CarRacingCustomDraw`, and the observations are
+    its state vectors (`observation="vector"`), all computed with NumPy for the whole
+    batch. Tiles are visited by the car center, which also decides the friction of
+    all its wheels. Finished cars start a new episode on the same track; `reset`
+    generates a new track for all of them.
+    """
+    def __init__(self, cars, seed=43, vector_tiles=10):
+        self.np_random, _ = seeding.np_random(seed)
+        self.cars = KinematicCars(cars)
+        self.vector_tiles = vector_tiles
+        self.states = np.zeros([cars, 11 + 2 * vector_tiles], dtype=np.float32)
+        self.rewards = np.zeros([cars], dtype=np.float32)
+        self.dones = np.zeros([cars], dtype=np.bool)
+        self.reward = np.zeros([cars])
+        self.prev_reward = np.zeros([cars])
+        self.visited_count = np.zeros([cars], dtype=np.int32)
+        self.frames = np.zeros([cars], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.states)
+
+    def reset(self, track=None):
+        """Start new episodes of all cars, on the given or a newly generated track."""
+        if track is None:
+            while True:
+                track = generate_track(self.np_random)
+                if track is not None: break
+        self.track = track[0]
+        alpha, beta, x, y = np.array(self.track).T
+        self.track_xy = np.stack([x, y], axis=1)
+        self._track_xy_norms = np.sum(np.square(self.track_xy), axis=1)
+
+        # Tile polygons of `CarRacingCustomDraw._build_track` as half-planes of their edges
+        offset = TRACK_WIDTH * np.stack([np.cos(beta), np.sin(beta)], axis=1)
+        prev_xy, prev_offset = np.roll(self.track_xy, 1, axis=0), np.roll(offset, 1, axis=0)
+        polygons = np.stack([self.track_xy - offset, self.track_xy + offset, prev_xy + prev_offset, prev_xy - prev_offset], axis=1)
+        edges = np.roll(polygons, -1, axis=1) - polygons
+        orientation = np.sign(np.sum(np.cross(polygons, np.roll(polygons, -1, axis=1)), axis=1))
+        self._tile_normals = np.stack([edges[:, :, 1], -edges[:, :, 0]], axis=2) * orientation[:, np.newaxis, np.newaxis]
+        self._tile_offsets = np.sum(self._tile_normals * polygons, axis=2)
+
+        self.visited = np.zeros([len(self), len(self.track)], dtype=np.bool)
+        self._start_episodes(np.ones([len(self)], dtype=np.bool))
+        self._observe()
+        return self.states
+
+    def step(self, actions, frame_skip=1):
+        """Step all cars, starting new episodes of the finished ones.
+
+        Returns `states`, `rewards` and `dones` arrays; for finished cars,
+        `states` contain the first observation of the next episode.
+        """
+        actions = np.asarray(actions)
+        self.rewards[:] = 0
+        self.dones[:] = False
+        for _ in range(max(frame_skip, 1)):
+            self.cars.steer(-actions[:, 0])
+            self.cars.gas(actions[:, 1])
+            self.cars.brake(actions[:, 2])
+            self.cars.step(1.0/FPS, np.repeat(self._tiles >= 0, 4).reshape([-1, 4]))
+            self._visit_tiles()
+
+            self.reward -= 0.1
+            step_reward = self.reward - self.prev_reward
+            self.prev_reward[:] = self.reward
+            x, y = self.cars.position.T
+            outside = (np.abs(x) > PLAYFIELD) | (np.abs(y) > PLAYFIELD)
+            step_reward[outside] = -100
+            self.frames += 1
+
+            running = ~self.dones
+            self.rewards[running] += step_reward[running]
+            self.dones |= (self.visited_count == len(self.track)) | outside | (self.frames > 1000)
+
+        if self.dones.any():
+            self._start_episodes(self.dones)
+        self._observe()
+        return self.states, self.rewards, self.dones
+
+    def _start_episodes(self, cars):
+        self.cars.place(cars, *self.track[0][1:4])
+        self.visited[cars] = False
+        for array in [self.visited_count, self.reward, self.prev_reward, self.frames]:
+            array[cars] = 0
+        self._visit_tiles()
+
+    def _visit_tiles(self):
+        points = self.cars.position
+        distances = self._track_xy_norms - 2 * np.dot(points, self.track_xy.T)
+        self._nearest = np.argmin(distances, axis=1)
+
+        # The car is on one of the two tiles adjacent to the nearest track point, or on grass
+        candidates = np.stack([self._nearest, (self._nearest + 1) % len(self.track)], axis=1)
+        inside = np.all(np.einsum("ncij,nj->nci", self._tile_normals[candidates], points) <= self._tile_offsets[candidates], axis=2)
+        self._tiles = np.where(inside[:, 0], candidates[:, 0], np.where(inside[:, 1], candidates[:, 1], -1))
+
+        cars = np.nonzero(self._tiles >= 0)[0]
+        new = cars[~self.visited[cars, self._tiles[cars]]]
+        self.visited[new, self._tiles[new]] = True
+        self.visited_count[new] += 1
+        self.reward[new] += 1000.0/len(self.track)
+
+    def _observe(self):
+        # Same layout as `CarRacingCustomDraw._state_vector`
+        cars = self.cars
+        self.states[:, 0:2] = cars.position
+        self.states[:, 2] = cars.angle
+        self.states[:, 3:5] = cars.velocity()
+        self.states[:, 5] = cars.angular_velocity
+        self.states[:, 6:10] = cars.omega
+        self.states[:, 10] = cars.steering
+
+        tiles = self.track_xy[(self._nearest[:, np.newaxis] + 1 + np.arange(self.vector_tiles)) % len(self.track)] - cars.position[:, np.newaxis]
+        sin, cos = np.sin(cars.angle)[:, np.newaxis], np.cos(cars.angle)[:, np.newaxis]
+        self.states[:, 11::2] = tiles[:, :, 0] * cos + tiles[:, :, 1] * sin
+        self.states[:, 12::2] = tiles[:, :, 1] * cos - tiles[:, :, 0] * sin
+
 
 ###############################
 # Evaluator for NPFL122 class #
@@ -772,14 +1596,66 @@ gym.envs.register(
 )
 
 import gym_evaluator
-def environment():
-    env = gym_evaluator.GymEnvironment("CarRacingCustomDraw-v0")
+def environment(track_library=None, sequential_tracks=False, prefetch_tracks=0, track_pool=0, profile=False,
+                log_episodes=False, **env_kwargs):
+    # Environments with non-default constructor arguments (observation size,
+    # grayscale, observation type, ...) are provided by separately registered variants
+    env_id = "CarRacingCustomDraw-v0"
+    if env_kwargs:
+        env_id = "CarRacingCustomDraw-{}-v0".format("-".join("{}:{}".format(*kwarg) for kwarg in sorted(env_kwargs.items())))
+        if env_id not in gym.envs.registry.env_specs:
+            gym.envs.register(id=env_id, entry_point=functools.partial(CarRacingCustomDraw, **env_kwargs), reward_threshold=900)
+    env = gym_evaluator.GymEnvironment(env_id)
+    if track_library is not None and not isinstance(track_library, TrackLibrary):
+        track_library = TrackLibrary(track_library)
+    def configure(car_racing):
+        if track_library is not None:
+            car_racing.use_track_library(track_library, sequential_tracks)
+        elif prefetch_tracks:
+            car_racing.use_track_prefetcher(prefetch_tracks)
+        if track_pool:
+            car_racing.use_track_pool(track_pool)
+        if profile:
+            car_racing.enable_profiling()
+        if log_episodes:
+            car_racing.log_episodes(directory=log_episodes if isinstance(log_episodes, str) else None)
+    configure(env._env.unwrapped)
+
+    # With `log_episodes`, the log of the current (or just finished) episode is returned
+    # by `episode_log()`; if `log_episodes` is a directory, every episode log is saved there.
+    def episode_log():
+        return env._env.unwrapped.episode_log
+    env.episode_log = episode_log
 
     def step(action, frame_skip=1):
         env._env.unwrapped.frame_skip = frame_skip
         return gym_evaluator.GymEnvironment.step(env, action)
     env.step = step
 
+    # The parallel environments are simulated in this process by CarRacingBatch,
+    # configured like the main environment. The returned states are copies, so
+    # they are not overwritten by later steps.
+    env._batch = None
+    def parallel_init(environments):
+        if env._batch is not None:
+            raise RuntimeError("The parallel_init method already called")
+        if track_library is None and prefetch_tracks:
+            raise ValueError("Track prefetching is not supported by the parallel environments")
+        if log_episodes:
+            raise ValueError("Episode logging is not supported by the parallel environments")
+        env._batch = CarRacingBatch(environments, **env_kwargs)
+        for batch_env in env._batch.envs:
+            configure(batch_env)
+        return env._batch.reset().copy()
+    env.parallel_init = parallel_init
+
+    def parallel_step(actions, frame_skip=1):
+        if env._batch is None:
+            raise RuntimeError("The parallel_init method was not called before parallel_step")
+        states, rewards, dones = env._batch.step(actions, frame_skip)
+        return [(state, reward, done, {}) for state, reward, done in zip(states.copy(), rewards, dones)]
+    env.parallel_step = parallel_step
+
     return env
 
 # Allow running the environment and  controlling it with arrows
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""Action generation and episode replay shared by the CarRacing comparison scripts."""
+import time
+
+import numpy as np
+
+import car_racing_evaluator
+
+def random_actions(episodes, steps, seed, hold=10):
+    """Return random actions of shape `[episodes, steps, 3]`.
+
+    Every action is held for `hold` steps, so that the car actually drives."""
+    np_random = np.random.RandomState(seed)
+    actions = np_random.uniform([-1, 0.2, 0], [1, 1, 0.2], size=[episodes, steps // hold + 1, 1, 3])
+    return np.repeat(actions, hold, axis=2).reshape([episodes, -1, 3])[:, :steps]
+
+def load_actions(path, episodes, steps, seed):
+    """Return the actions recorded in the `.npy` file `path`, or random ones if it is None."""
+    return np.load(path) if path is not None else random_actions(episodes, steps, seed)
+
+def replay(actions, seed, record, **env_kwargs):
+    """Perform `actions` in a new `CarRacingCustomDraw(**env_kwargs)` seeded by `seed`.
+
+    Returns the initial state, the results of `record(env, state, reward, done)`
+    after every step until the episode ends, and the mean time of a step."""
+    env = car_racing_evaluator.CarRacingCustomDraw(**env_kwargs)
+    env.seed(seed)
+    initial_state, records, elapsed = env.reset(), [], 0
+    for action in actions:
+        start = time.perf_counter()
+        state, reward, done, _ = env.step(action)
+        elapsed += time.perf_counter() - start
+        records.append(record(env, state, reward, done))
+        if done: break
+    env.close()
+    return initial_state, records, elapsed / len(records)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""Check that headless CarRacing simulates exactly like the normal one.
+
+Every action sequence is replayed with `headless=False` and `headless=True` on
+the same seeds, and the rewards, done flags, vector observations and visited
+tiles are required to be equal; the time per step of both modes is reported."""
+import argparse
+
+import numpy as np
+
+import car_racing_harness
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--episodes", default=5, type=int, help="Episodes of random actions.")
+parser.add_argument("--steps", default=500, type=int, help="Steps of random actions.")
+parser.add_argument("--tile_tracking", default="contacts,geometric", type=str, help="Tile tracking modes to check.")
+parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+args = parser.parse_args()
+
+actions = car_racing_harness.random_actions(args.episodes, args.steps, args.seed)
+
+def run(headless, tile_tracking, episode_actions, seed):
+    """Return the states, per-step rewards, dones and visited tiles, and time per step."""
+    initial_state, records, step_time = car_racing_harness.replay(
+        episode_actions, seed, lambda env, state, reward, done: (state, reward, done, env.tile_visited_count),
+        observation="vector", tile_tracking=tile_tracking, headless=headless)
+    states, rewards, dones, visited = zip(*records)
+    return np.array((initial_state,) + states), rewards, dones, visited, step_time
+
+for tile_tracking in args.tile_tracking.split(","):
+    step_times = {False: [], True: []}
+    for i, episode_actions in enumerate(actions):
+        normal = run(False, tile_tracking, episode_actions, args.seed + i)
+        headless = run(True, tile_tracking, episode_actions, args.seed + i)
+        assert np.array_equal(normal[0], headless[0]), "Observations differ in episode {}".format(i)
+        assert normal[1] == headless[1], "Rewards differ in episode {}".format(i)
+        assert normal[2] == headless[2], "Done flags differ in episode {}".format(i)
+        assert normal[3] == headless[3], "Visited tiles differ in episode {}".format(i)
+        step_times[False].append(normal[4])
+        step_times[True].append(headless[4])
+    print("{} tile tracking: {} episodes identical, {:.1f} us/step normal, {:.1f} us/step headless".format(
+        tile_tracking, len(actions), 1e6 * np.mean(step_times[False]), 1e6 * np.mean(step_times[True])))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Validate the kinematic CarRacing backend against the Box2D one.
+
+Every action sequence is replayed with both backends on the same track, and the
+divergence of the car trajectories and episode rewards is reported at several
+horizons, together with the throughput of both backends."""
+import argparse
+import time
+
+import numpy as np
+
+import car_racing_evaluator
+import car_racing_harness
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--actions", default=None, type=str, help="Recorded actions, .npy of shape [episodes, steps, 3].")
+parser.add_argument("--batch", default=1000, type=int, help="Cars of the batch throughput measurement.")
+parser.add_argument("--episodes", default=10, type=int, help="Episodes of random actions, if --actions not given.")
+parser.add_argument("--horizons", default="10,25,50,100,200,500", type=str, help="Steps to report divergence at.")
+parser.add_argument("--steps", default=500, type=int, help="Steps of random actions, if --actions not given.")
+parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+args = parser.parse_args()
+
+actions = car_racing_harness.load_actions(args.actions, args.episodes, args.steps, args.seed)
+
+def replay(backend, episode_actions, seed):
+    """Return per-step hull states [x, y, angle, speed], rewards and time per step."""
+    _, records, step_time = car_racing_harness.replay(
+        episode_actions, seed, lambda env, state, reward, done: (
+            [*env.car.hull.position, env.car.hull.angle, np.linalg.norm(env.car.hull.linearVelocity)], reward),
+        observation="vector", backend=backend)
+    states, rewards = zip(*records)
+    return np.array(states), np.cumsum(rewards), step_time
+
+horizons = [int(horizon) for horizon in args.horizons.split(",")]
+errors = {horizon: [] for horizon in horizons}
+step_times = {"box2d": [], "kinematic": []}
+for i, episode_actions in enumerate(actions):
+    box2d, box2d_rewards, box2d_time = replay("box2d", episode_actions, args.seed + i)
+    kinematic, kinematic_rewards, kinematic_time = replay("kinematic", episode_actions, args.seed + i)
+    step_times["box2d"].append(box2d_time)
+    step_times["kinematic"].append(kinematic_time)
+    for horizon in horizons:
+        if horizon > min(len(box2d), len(kinematic)): continue
+        b, k = box2d[horizon - 1], kinematic[horizon - 1]
+        errors[horizon].append([np.linalg.norm(b[:2] - k[:2]), abs(np.angle(np.exp(1j * (b[2] - k[2])))),
+                                abs(b[3] - k[3]), abs(box2d_rewards[horizon - 1] - kinematic_rewards[horizon - 1])])
+
+print("{:>8} {:>8} {:>10} {:>10} {:>10} {:>12}".format("horizon", "episodes", "position", "angle", "speed", "reward.diff"))
+for horizon in horizons:
+    if not errors[horizon]: continue
+    position, angle, speed, reward = np.mean(errors[horizon], axis=0)
+    print("{:>8} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.2f}".format(horizon, len(errors[horizon]), position, angle, speed, reward))
+
+batch = car_racing_evaluator.KinematicCarRacingBatch(args.batch, seed=args.seed)
+batch.reset()
+batch_actions = np.random.RandomState(args.seed).uniform([-1, 0, 0], [1, 1, 0.2], size=[args.batch, 3])
+start = time.perf_counter()
+for _ in range(100):
+    batch.step(batch_actions)
+batch_time = (time.perf_counter() - start) / 100
+
+print("Box2D env: {:.0f} steps/s, kinematic env: {:.0f} steps/s, kinematic batch of {}: {:.0f} car steps/s".format(
+    1 / np.mean(step_times["box2d"]), 1 / np.mean(step_times["kinematic"]), args.batch, args.batch / batch_time))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Compare CarRacing physics profiles against the reference one.
+
+Every action sequence is replayed under every profile, and the divergence of the
+car trajectory and of the episode reward from the reference profile is reported."""
+import argparse
+import sys
+
+import numpy as np
+
+import car_racing_evaluator
+import car_racing_harness
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--actions", default=None, type=str, help="Recorded actions, .npy of shape [episodes, steps, 3].")
+parser.add_argument("--episodes", default=5, type=int, help="Episodes of random actions, if --actions not given.")
+parser.add_argument("--steps", default=500, type=int, help="Steps of random actions, if --actions not given.")
+parser.add_argument("--profiles", default=",".join(car_racing_evaluator.PHYSICS_PROFILES), type=str, help="Profiles to compare.")
+parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+args = parser.parse_args()
+
+actions = car_racing_harness.load_actions(args.actions, args.episodes, args.steps, args.seed)
+
+def replay(profile, episode_actions, seed):
+    """Return per-step hull states [x, y, angle, vx, vy], total reward and time per step."""
+    _, records, step_time = car_racing_harness.replay(
+        episode_actions, seed, lambda env, state, reward, done: (
+            [*env.car.hull.position, env.car.hull.angle, *env.car.hull.linearVelocity], reward),
+        observation="vector", physics=profile)
+    states, rewards = zip(*records)
+    return np.array(states), sum(rewards), step_time
+
+reference = [replay("reference", episode_actions, args.seed + i) for i, episode_actions in enumerate(actions)]
+print("{:>16} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+    "profile", "us/step", "pos.mean", "pos.max", "angle.max", "reward.diff"))
+for profile in args.profiles.split(","):
+    position, angle, reward, step_time = [], [], [], []
+    for i, episode_actions in enumerate(actions):
+        states, total_reward, elapsed = replay(profile, episode_actions, args.seed + i)
+        ref_states, ref_reward, _ = reference[i]
+        steps = min(len(states), len(ref_states))
+        position.append(np.linalg.norm(states[:steps, :2] - ref_states[:steps, :2], axis=1))
+        angle.append(np.abs(np.angle(np.exp(1j * (states[:steps, 2] - ref_states[:steps, 2])))))
+        reward.append(abs(total_reward - ref_reward))
+        step_time.append(elapsed)
+    position, angle = np.concatenate(position), np.concatenate(angle)
+    print("{:>16} {:>10.1f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.2f}".format(
+        profile, 1e6 * np.mean(step_time), np.mean(position), np.max(position), np.max(angle), np.mean(reward)))
+    sys.stdout.flush()
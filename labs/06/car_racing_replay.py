@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Re-simulate a logged CarRacing episode and show or export the given steps."""
+import argparse
+import sys
+
+import car_racing_evaluator
+
+parser = argparse.ArgumentParser()
+parser.add_argument("log", type=str, help="Episode log saved by EpisodeLog.save.")
+parser.add_argument("--first_step", default=0, type=int, help="First step to render.")
+parser.add_argument("--last_step", default=None, type=int, help="Last step to render.")
+parser.add_argument("--track_library", default=None, type=str, help="Track library to load the track from.")
+parser.add_argument("--video", default=None, type=str, help="Export the steps to this video file instead of showing them.")
+args = parser.parse_args()
+
+log = car_racing_evaluator.EpisodeLog.load(args.log)
+# The environment is created with the same arguments as the logging one
+env = car_racing_evaluator.CarRacingCustomDraw(**(log.config or {}))
+if args.track_library is not None:
+    env.use_track_library(car_racing_evaluator.TrackLibrary(args.track_library))
+steps = range(args.first_step, (len(log) if args.last_step is None else args.last_step) + 1)
+
+encoder, total_reward = None, 0
+for step, state, reward, done in env.replay(log, steps):
+    total_reward += reward
+    if args.video is None:
+        env.render()
+        continue
+    image = env.display_image(state)
+    if encoder is None:
+        from gym.monitoring.video_recorder import ImageEncoder
+        encoder = ImageEncoder(args.video, image.shape, car_racing_evaluator.FPS)
+    encoder.capture_frame(image)
+if encoder is not None:
+    encoder.close()
+env.close()
+print("Replayed steps {}-{} of {}, reward in them {:.2f}".format(steps.start, steps.stop - 1, len(log), total_reward), file=sys.stderr)
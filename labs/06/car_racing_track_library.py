@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""Precompute a library of CarRacing tracks for a range of seeds."""
+import argparse
+import sys
+
+import car_racing_evaluator
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--first_seed", default=0, type=int, help="First seed of the library.")
+parser.add_argument("--tracks", default=1000, type=int, help="Number of tracks (consecutive seeds).")
+parser.add_argument("path", type=str, help="Directory to store the library to.")
+args = parser.parse_args()
+
+library = car_racing_evaluator.TrackLibrary.create(args.path, range(args.first_seed, args.first_seed + args.tracks))
+print("Track library `{}` with {} tracks created.".format(args.path, len(library)), file=sys.stderr)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Measure CartPolePixels rendering speed of the vectorized drawing and of the polygon filling."""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import cart_pole_pixels_evaluator
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--frames", default=10000, type=int, help="Frames to render.")
+parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+args = parser.parse_args()
+
+np.random.seed(args.seed)
+states = np.random.uniform([-2.4, 0, -0.21, 0], [2.4, 0, 0.21, 0], size=[args.frames, 4])
+env = cart_pole_pixels_evaluator.CartPolePixels()
+
+for name, draw in [("polygons", env._draw_polygons), ("vectorized", env._draw)]:
+    start = time.perf_counter()
+    for state in states:
+        draw(state)
+    print("{}: {:.0f} frames/s".format(name, args.frames / (time.perf_counter() - start)), file=sys.stderr)
+
+start = time.perf_counter()
+env._draw_frames(states)
+print("vectorized, all at once: {:.0f} frames/s".format(args.frames / (time.perf_counter() - start)), file=sys.stderr)
+
+differences = [np.sum(env._draw(state) != env._draw_polygons(state)) for state in states]
+print("Frames differing: {:.1f}%, differing pixels per frame: {:.2f}".format(
+    100 * np.mean(np.array(differences) > 0), np.mean(differences)), file=sys.stderr)
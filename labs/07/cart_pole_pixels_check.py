@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Check that parallel CartPolePixels environments observe exactly what single ones do.
+
+The environments of `parallel_init` are replayed by single `CartPolePixels`
+environments started in the same physics states and given the same actions,
+and the observations, rewards and done flags of `parallel_step` and `step`
+are required to be identical until the end of every episode."""
+import argparse
+
+import numpy as np
+
+import cart_pole_pixels_evaluator
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--environments", default=16, type=int, help="Parallel environments.")
+parser.add_argument("--steps", default=200, type=int, help="Steps of random actions.")
+parser.add_argument("--dtypes", default="float32,uint8", type=str, help="Observation dtypes to check.")
+parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+args = parser.parse_args()
+
+np.random.seed(args.seed)
+actions = np.random.randint(2, size=[args.steps, args.environments])
+
+for dtype in args.dtypes.split(","):
+    env = cart_pole_pixels_evaluator.environment(dtype=dtype)
+    states = env.parallel_init(args.environments)
+
+    # Single environments started in the physics states of the parallel ones
+    singles = []
+    for i in range(args.environments):
+        single = cart_pole_pixels_evaluator.CartPolePixels(dtype=dtype)
+        single.reset()
+        single.state = env._batch.physics[i].copy()
+        single._frames = [single._draw(single.state)] * single._images
+        assert np.array_equal(np.asarray(single._observation()), states[i]), "Initial observations differ"
+        singles.append(single)
+
+    compared, running = 0, np.ones(args.environments, dtype=np.bool)
+    for step_actions in actions:
+        results = env.parallel_step(step_actions)
+        for i in np.nonzero(running)[0]:
+            state, reward, done, _ = singles[i].step(step_actions[i])
+            parallel_state, parallel_reward, parallel_done, _ = results[i]
+            assert parallel_reward == reward, "Rewards differ in environment {}".format(i)
+            assert parallel_done == done, "Done flags differ in environment {}".format(i)
+            # A finished parallel environment already observes its next episode
+            if done:
+                running[i] = False
+            else:
+                assert np.array_equal(parallel_state, np.asarray(state)), "Observations differ in environment {}".format(i)
+                compared += 1
+        if not running.any(): break
+    print("{} observations: {} steps of {} environments identical".format(dtype, compared, args.environments))
@@ -1,27 +1,69 @@
 #!/usr/bin/env python3
+import functools
+
 import gym
 import gym.envs.classic_control
 import numpy as np
 
+class FrameStack:
+    """Observation stacking the given frames along the last axis, materialized lazily.
+
+    Consecutive observations share their frames, so storing them (for example in
+    a replay buffer) keeps every frame only once; `np.asarray` returns the stack.
+    """
+    def __init__(self, frames):
+        self._frames = frames
+
+    def __array__(self, dtype=None):
+        stack = np.stack(self._frames, axis=-1)
+        return stack if dtype is None else stack.astype(dtype, copy=False)
+
+    def __len__(self):
+        return len(self._frames[0])
+
+    def __getitem__(self, index):
+        return np.asarray(self)[index]
+
+    @property
+    def shape(self):
+        return self._frames[0].shape + (len(self._frames),)
+
+    @property
+    def dtype(self):
+        return self._frames[0].dtype
+
+    def frame(self, index=-1):
+        return self._frames[index]
+
 class CartPolePixels(gym.envs.classic_control.CartPoleEnv):
-    def __init__(self):
+    def __init__(self, width=80, height=80, images=3, dtype="float32"):
         super().__init__()
 
-        self._images = 3
-        self._image = np.zeros([80, 80, self._images], dtype=np.float32)
+        # Frames are drawn natively in the given resolution and dtype; integer
+        # dtypes use colors scaled to 0-255.
+        self._width, self._height, self._images = width, height, images
+        self._dtype = np.dtype(dtype)
+        self._colors = (0.5, 1.) if self._dtype.kind == "f" else (127, 255)
+        self._base = height * 7 // 8  # Top of the cart, bottom of the pole
+        self._frames = [None] * self._images  # Circular store of the last frames
+        self._frame = 0                       # Index of the newest frame
         self._viewer = None
 
-        self.observation_space = gym.spaces.Box(low=0., high=1., shape=(80, 80, self._images))
+        self.observation_space = gym.spaces.Box(low=0., high=self._colors[1], shape=(height, width, images))
 
     def _reset(self):
         observation = super()._reset()
-        for step in range(self._images - 1):
-            self._draw(observation)
-        return self._draw(observation)
+        self._frames = [self._draw(observation)] * self._images
+        return self._observation()
 
     def _step(self, action):
         observation, reward, done, info = super()._step(action)
-        return self._draw(observation), reward, done, info
+        self._frame = (self._frame + 1) % self._images
+        self._frames[self._frame] = self._draw(observation)
+        return self._observation(), reward, done, info
+
+    def _observation(self):
+        return FrameStack([self._frames[(self._frame + 1 + i) % self._images] for i in range(self._images)])
 
     def _render(self, mode='human', close=False):
         if close:
@@ -34,18 +76,71 @@ class CartPolePixels(gym.envs.classic_control.CartPoleEnv):
             from gym.envs.classic_control import rendering
             self._viewer = rendering.SimpleImageViewer()
 
-        self._viewer.imshow((self._image.repeat(8, axis=0).repeat(8, axis=1)*255).astype(np.uint8))
+        # The last (at most) three frames are shown as RGB channels
+        image = np.zeros([self._height, self._width, 3], dtype=np.float32)
+        frames = min(self._images, 3)
+        image[:, :, 3 - frames:] = np.asarray(self._observation())[:, :, -frames:]
+        upscale = max(640 // self._width, 1)
+        self._viewer.imshow((image.repeat(upscale, axis=0).repeat(upscale, axis=1)*255/self._colors[1]).astype(np.uint8))
+
+    def _geometry(self, observation):
+        """Return the cart center column, and the pole top column and row."""
+        scale_x, scale_y = self._width / 2, self._height / 2
+        cart = scale_x + observation[0] / 3 * scale_x
+        pole_x = int(scale_x + (observation[0] + np.sin(observation[2]) * 4.2) / 3 * scale_x)
+        pole_y = int(self._base - np.cos(observation[2]) * 5.2 / 3 * scale_y)
+        return cart, pole_x, pole_y
 
     def _draw(self, observation):
-        for i in range(self._images - 1):
-            self._image[:, :, i] = self._image[:, :, i + 1]
-        cart = 40 + observation[0] / 3 * 40
-        pole_x = int(40 + (observation[0] + np.sin(observation[2]) * 4.2) / 3 * 40)
-        pole_y = int(70 - np.cos(observation[2]) * 5.2 / 3 * 40)
-        self._image[:, :, self._images - 1] = 0
-        self._fill_polygon([(70, cart-10), (80, cart-10), (80, cart+10), (70, cart+10)], self._image[:, :, self._images - 1], 0.5)
-        self._fill_polygon([(pole_y, pole_x-2), (70, cart-2), (70, cart+2), (pole_y, pole_x+2)], self._image[:, :, self._images - 1], 1)
-        return np.copy(self._image)
+        # Every frame is drawn into a new array, so the returned observations stay valid
+        return self._draw_frames(np.asarray(observation)[np.newaxis])[0]
+
+    def _draw_polygons(self, observation):
+        # The original drawing of a frame with _fill_polygon, which _draw_frames reproduces
+        image = np.zeros([self._height, self._width], dtype=self._dtype)
+        cart, pole_x, pole_y = self._geometry(observation)
+        cart_width, pole_width = self._width / 8, self._width / 40
+        self._fill_polygon([(self._base, cart-cart_width), (self._height, cart-cart_width),
+                            (self._height, cart+cart_width), (self._base, cart+cart_width)], image, self._colors[0])
+        self._fill_polygon([(pole_y, pole_x-pole_width), (self._base, cart-pole_width),
+                            (self._base, cart+pole_width), (pole_y, pole_x+pole_width)], image, self._colors[1])
+        return image
+
+    @staticmethod
+    def _columns(starts, ends, width):
+        """Mask of the columns selected by `canvas[..., start:end]`, negative indices included."""
+        starts = np.where(starts < 0, np.maximum(starts + width, 0), np.minimum(starts, width)).astype(np.int16)
+        ends = np.where(ends < 0, np.maximum(ends + width, 0), np.minimum(ends, width)).astype(np.int16)
+        columns = np.arange(width, dtype=np.int16)
+        return (columns >= starts[..., np.newaxis]) & (columns < ends[..., np.newaxis])
+
+    def _draw_frames(self, physics):
+        """Draw frames of the given `[frames, 4]` physics states, exactly as by `_draw_polygons`.
+
+        Both CartPolePixels and CartPolePixelsBatch draw their frames this way, so
+        their observations of the same states are identical."""
+        # The cart and pole polygons are filled by the same scanlines as in _fill_polygon
+        width, height, base = self._width, self._height, self._base
+        cart_width, pole_width = width / 8, width / 40
+        x, theta = physics[:, 0], physics[:, 2]
+        cart = width / 2 + x / 3 * (width / 2)
+        pole_x = (width / 2 + (x + np.sin(theta) * 4.2) / 3 * (width / 2)).astype(np.int64)
+        pole_y = (base - np.cos(theta) * 5.2 / 3 * (height / 2)).astype(np.int64)
+
+        cart_columns = self._columns((cart - cart_width).astype(np.int64), (cart + cart_width + 1).astype(np.int64), width)
+
+        cart, pole_x, pole_y = cart[:, np.newaxis], pole_x[:, np.newaxis], pole_y[:, np.newaxis]
+        rows = np.arange(height)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            left = (cart-pole_width) + (rows - base) / (pole_y - base) * ((pole_x-pole_width) - (cart-pole_width))
+            right = (pole_x+pole_width) + (rows - pole_y) / (base - pole_y) * ((cart+pole_width) - (pole_x+pole_width))
+        pole_rows = (rows > pole_y) & (rows <= base)
+        starts = np.where(pole_rows, np.minimum(left, right), 0).astype(np.int64)
+        ends = np.where(pole_rows, np.maximum(left, right) + 1, 0).astype(np.int64)
+        frames = self._columns(starts, ends, width).astype(self._dtype) * self._dtype.type(self._colors[1])
+        np.maximum(frames[:, base + 1:], self._dtype.type(self._colors[0]) * cart_columns[:, np.newaxis],
+                   out=frames[:, base + 1:])
+        return frames
 
     # Taken from https://github.com/luispedro/mahotas/blob/master/mahotas/polygon.py
     def _fill_polygon(self, polygon, canvas, color=1):
@@ -86,6 +181,68 @@ class CartPolePixels(gym.envs.classic_control.CartPoleEnv):
                 nn += 1
                 canvas[y, int(n):int(nn)] = color
 
+class CartPolePixelsBatch:
+    """Several CartPolePixels environments simulated and drawn at once with NumPy.
+
+    The physics follows CartPoleEnv and the frames of all environments are drawn
+    together by `CartPolePixels._draw_frames`, which single environments use too.
+    Observations are stored in one preallocated `states` array of shape
+    `[environments, height, width, images]`, which is overwritten by every `reset`
+    and `step`. Finished environments, also those reaching `max_episode_steps`,
+    are reset automatically.
+    """
+    def __init__(self, environments, seed=42, max_episode_steps=500, width=80, height=80, images=3, dtype="float32"):
+        self._cart_pole = CartPolePixels(width, height, images, dtype)
+        self.np_random, _ = gym.utils.seeding.np_random(seed)
+        self.max_episode_steps = max_episode_steps
+        self.physics = np.zeros([environments, 4])
+        self.steps = np.zeros([environments], dtype=np.int32)
+        self.states = np.zeros([environments, height, width, images], dtype=self._cart_pole._dtype)
+        self.rewards = np.ones([environments], dtype=np.float32)
+        self.dones = np.zeros([environments], dtype=np.bool)
+
+    def __len__(self):
+        return len(self.states)
+
+    def reset(self):
+        self._reset(np.ones([len(self)], dtype=np.bool))
+        return self.states
+
+    def step(self, actions):
+        """Step all environments, resetting the finished ones.
+
+        Returns `states`, `rewards` and `dones` arrays; for finished environments,
+        `states` contain the first observation of the next episode.
+        """
+        env = self._cart_pole
+        x, x_dot, theta, theta_dot = self.physics.T
+        force = np.where(np.asarray(actions) == 1, env.force_mag, -env.force_mag)
+        costheta, sintheta = np.cos(theta), np.sin(theta)
+        temp = (force + env.polemass_length * theta_dot * theta_dot * sintheta) / env.total_mass
+        thetaacc = (env.gravity * sintheta - costheta * temp) / (env.length * (4.0/3.0 - env.masspole * costheta * costheta / env.total_mass))
+        xacc = temp - env.polemass_length * thetaacc * costheta / env.total_mass
+        self.physics = np.stack([x + env.tau * x_dot, x_dot + env.tau * xacc,
+                                 theta + env.tau * theta_dot, theta_dot + env.tau * thetaacc], axis=1)
+        self.steps += 1
+
+        x, theta = self.physics[:, 0], self.physics[:, 2]
+        self.dones = (np.abs(x) > env.x_threshold) | (np.abs(theta) > env.theta_threshold_radians) | \
+            (self.steps >= self.max_episode_steps)
+        for i in range(self.states.shape[-1] - 1):
+            self.states[..., i] = self.states[..., i + 1]
+        self.states[..., -1] = self._draw(self.physics)
+        if self.dones.any():
+            self._reset(self.dones)
+        return self.states, self.rewards, self.dones
+
+    def _reset(self, environments):
+        self.physics[environments] = self.np_random.uniform(low=-0.05, high=0.05, size=(np.sum(environments), 4))
+        self.steps[environments] = 0
+        self.states[environments] = self._draw(self.physics[environments])[..., np.newaxis]
+
+    def _draw(self, physics):
+        return self._cart_pole._draw_frames(physics)
+
 ###############################
 # Evaluator for NPFL122 class #
 ###############################
@@ -98,8 +255,37 @@ gym.envs.register(
 )
 
 import gym_evaluator
-def environment():
-    return gym_evaluator.GymEnvironment("CartPolePixels-v0")
+def environment(**env_kwargs):
+    # Environments with non-default frame size, history depth or dtype
+    # are provided by separately registered variants
+    if "dtype" in env_kwargs:
+        env_kwargs["dtype"] = np.dtype(env_kwargs["dtype"]).name
+    env_id = "CartPolePixels-v0"
+    if env_kwargs:
+        env_id = "CartPolePixels-{}-v0".format("-".join("{}:{}".format(*kwarg) for kwarg in sorted(env_kwargs.items())))
+        if env_id not in gym.envs.registry.env_specs:
+            gym.envs.register(id=env_id, entry_point=functools.partial(CartPolePixels, **env_kwargs),
+                              max_episode_steps=500, reward_threshold=475)
+    env = gym_evaluator.GymEnvironment(env_id)
+
+    # The parallel environments are simulated in this process by CartPolePixelsBatch.
+    # The returned states are copies, so they are not overwritten by later steps.
+    env._batch = None
+    def parallel_init(environments):
+        if env._batch is not None:
+            raise RuntimeError("The parallel_init method already called")
+        env._batch = CartPolePixelsBatch(environments, **env_kwargs)
+        return env._batch.reset().copy()
+    env.parallel_init = parallel_init
+
+    def parallel_step(actions):
+        if env._batch is None:
+            raise RuntimeError("The parallel_init method was not called before parallel_step")
+        states, rewards, dones = env._batch.step(actions)
+        return [(state, reward, done, {}) for state, reward, done in zip(states.copy(), rewards, dones)]
+    env.parallel_step = parallel_step
+
+    return env
 
 # Allow running the environment and controlling it with arrows
 if __name__=="__main__":
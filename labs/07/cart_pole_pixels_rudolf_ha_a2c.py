@@ -65,10 +65,8 @@ class Network:
 			# Only this part of the network will be saved, in order not to save
 			# optimizer variables (e.g., estimates of the gradient moments).
 
-			# preprocess image
-			resized_input = tf.image.resize_images(self.states, size=[80, 80])
-			# grayscale_input = tf.image.rgb_to_grayscale(resized_input)
-			input = resized_input
+			# frames are already rendered in the environment resolution
+			input = self.states
 
 			cnn_desc = args.cnn.split(',')
 
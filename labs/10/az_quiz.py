@@ -1,6 +1,65 @@
 #!/usr/bin/env python3
+import itertools
+
 import numpy as np
 
+def _neighbours(j, i, N=7):
+    """Actions of the cells adjacent to the cell in row `j` and column `i`."""
+    return tuple(y * (y + 1) // 2 + x for y, x in [(j - 1, i - 1), (j - 1, i), (j, i - 1), (j, i + 1), (j + 1, i), (j + 1, i + 1)]
+                 if 0 <= x <= y < N)
+
+def _sides(j, i, N=7):
+    """Bitmask of the board sides (left, right, bottom) touched by the cell in row `j` and column `i`."""
+    return (i == 0) | (i == j) << 1 | (j == N - 1) << 2
+
+def _symmetries(N=7):
+    """Action permutations of the six board symmetries.
+
+    The symmetries permute the distances of a cell from the left, right and
+    bottom side; the identity is the first one."""
+    cells = [(i, j - i, N - 1 - j) for j in range(N) for i in range(j + 1)]
+    actions = {cell: action for action, cell in enumerate(cells)}
+    return np.array([[actions[tuple(cell[k] for k in permutation)] for cell in cells]
+                     for permutation in itertools.permutations(range(3))], dtype=np.int64)
+
+def augment(boards, policies):
+    """Return board tensors and action policies of all symmetric positions.
+
+    Given `boards` of shape `[B, N, N, C]` and `policies` of shape `[B, actions]`,
+    returns arrays of shapes `[6 * B, N, N, C]` and `[6 * B, actions]`, with
+    the B positions of the identity first. Only the cells of the triangle are
+    permuted, the other ones are kept."""
+    boards, policies = np.asarray(boards), np.asarray(policies)
+    inverse = AZQuiz._SYMMETRIES_INVERSE
+    cells = boards[:, AZQuiz._ACTION_Y, AZQuiz._ACTION_X]
+    augmented = np.repeat(boards[np.newaxis], len(inverse), axis=0)
+    augmented[:, :, AZQuiz._ACTION_Y, AZQuiz._ACTION_X] = np.swapaxes(cells[:, inverse], 0, 1)
+    augmented_policies = np.swapaxes(policies[:, inverse], 0, 1)
+    return augmented.reshape((-1,) + boards.shape[1:]), augmented_policies.reshape([-1, policies.shape[1]])
+
+def encode(games, to_play=False, symmetry=None):
+    """Encode games into board tensors of shape `[B, N, N, C]` of float32.
+
+    The `games` are either a list of AZQuiz or AZQuizBitboard games, or an
+    AZQuizBatch. The first C planes are those of `AZQuiz.board`. With `to_play`,
+    a plane with the player to move on the board cells is appended. With
+    `symmetry`, either one for all games or one per game, the positions are
+    encoded transformed by the given symmetries, as by `augment`."""
+    if isinstance(games, AZQuizBatch):
+        fields, players = games._cells(), games.to_play
+    else:
+        fields = np.array([game._cells() if isinstance(game, AZQuizBitboard) else game._board[AZQuiz._TRIANGLE]
+                           for game in games], dtype=np.int64)
+        players = np.array([game._to_play for game in games])
+    if symmetry is not None:
+        fields = fields[np.arange(len(fields))[:, np.newaxis], AZQuiz._SYMMETRIES_INVERSE[symmetry]]
+
+    board = np.zeros([len(fields), AZQuiz.N, AZQuiz.N, AZQuiz.C + bool(to_play)], dtype=np.float32)
+    board[:, AZQuiz._ACTION_Y, AZQuiz._ACTION_X, :AZQuiz.C] = AZQuiz._REPRESENTATION[fields]
+    if to_play:
+        board[:, AZQuiz._ACTION_Y, AZQuiz._ACTION_X, AZQuiz.C] = players[:, np.newaxis]
+    return board
+
 class AZQuiz:
     actions = 28
     N = 7
@@ -13,19 +72,30 @@ class AZQuiz:
         self._winner = None
         self._viewer = None
 
+        # Union-find of the captured cells (indexed by actions), and the sides
+        # touched by every component stored in its root. Components never contain
+        # cells of both players, so a single structure serves both of them and
+        # stays valid when swapping players.
+        self._parent = list(range(self.actions))
+        self._sides = list(self._SIDES)
+
+        # Zobrist hash of the cells and the player to move, updated by every move
+        self._hash = 0
+
     def clone(self):
         clone = AZQuiz(self._randomized)
         clone._board[:, :] = self._board
         clone._to_play = self._to_play
         clone._winner = self._winner
+        clone._parent = self._parent[:]
+        clone._sides = self._sides[:]
+        clone._hash = self._hash
         return clone
 
     @property
     def board(self):
         board = np.zeros([self.N, self.N, self.C], dtype=np.bool)
-        for j in range(self.N):
-            for i in range(j + 1):
-                board[j, i] = self._REPRESENTATION[self._board[j, i]]
+        board[self._TRIANGLE] = self._REPRESENTATION[self._board[self._TRIANGLE]]
         return board
 
     @property
@@ -36,10 +106,16 @@ class AZQuiz:
     def winner(self):
         return self._winner
 
+    @property
+    def hash(self):
+        """Zobrist hash of the cells and the player to move."""
+        return self._hash
+
     def swap_players(self):
         self._board = self._SWAP_PLAYERS[self._board]
         self._to_play = 1 - self._to_play
         self._winner = 1 - self._winner if self._winner is not None else None
+        self._hash = self._compute_hash()
 
     def valid(self, action):
         return self._winner is None and action >= 0 and action < self.actions \
@@ -66,7 +142,8 @@ class AZQuiz:
         if not self.valid(action):
             raise ValueError("An invalid action to AZQuiz.move")
 
-        if self._board[self._ACTION_Y[action], self._ACTION_X[action]] == 0:
+        previous, to_play = self._board[self._ACTION_Y[action], self._ACTION_X[action]], self._to_play
+        if previous == 0:
             if random_value <= self._INITIAL_QUESTION_PROB:
                 self._board[self._ACTION_Y[action], self._ACTION_X[action]] = 2 + self._to_play
             else:
@@ -77,29 +154,50 @@ class AZQuiz:
             self._board[self._ACTION_Y[action], self._ACTION_X[action]] = 2 + self._to_play
         self._to_play = 1 - self._to_play
 
-        edges, visited = np.zeros(2, dtype=np.bool), np.zeros([self.N, self.N], dtype=np.bool)
-        for j in range(self.N):
-            edges[:] = False
-            field = self._board[j, 0]
-            if field >= 2:
-                self._traverse(j, 0, field, edges, visited)
-                if edges.all():
-                    self._winner = field - 2
-
-    def _traverse(self, j, i, field, edges, visited):
-        if visited[j, i]: return
-        visited[j, i] = True
-
-        if j == i: edges[0] = True
-        if j == self.N - 1: edges[1] = True
-        if j - 1 >= 0:
-            if i - 1 >= 0 and self._board[j - 1, i - 1] == field: self._traverse(j - 1, i - 1, field, edges, visited)
-            if self._board[j - 1, i] == field: self._traverse(j - 1, i, field, edges, visited)
-        if i - 1 >= 0 and self._board[j, i - 1] == field: self._traverse(j, i - 1, field, edges, visited)
-        if i + 1 < self.N and self._board[j, i + 1] == field: self._traverse(j, i + 1, field, edges, visited)
-        if j + 1 < self.N:
-            if self._board[j + 1, i] == field: self._traverse(j + 1, i, field, edges, visited)
-            if i + 1 < self.N and self._board[j + 1, i + 1] == field: self._traverse(j + 1, i + 1, field, edges, visited)
+        field = self._board[self._ACTION_Y[action], self._ACTION_X[action]]
+        self._hash ^= self._ZOBRIST[action][previous] ^ self._ZOBRIST[action][field]
+        if self._to_play != to_play:
+            self._hash ^= self._ZOBRIST_TO_PLAY
+
+        # Only the component of a newly captured cell can connect all three sides
+        if field >= 2:
+            root = action
+            for neighbour in self._NEIGHBOURS[action]:
+                if self._board[self._ACTION_Y[neighbour], self._ACTION_X[neighbour]] == field:
+                    root = self._union(root, neighbour)
+            if self._sides[root] == self._ALL_SIDES:
+                self._winner = field - 2
+
+    def canonical_hash(self):
+        """Return the smallest hash of the six symmetric positions, and the symmetry giving it.
+
+        Symmetry `s` maps action `a` to `_SYMMETRIES[s, a]`, so a policy of this
+        position is mapped to the canonical one by `policy[_SYMMETRIES_INVERSE[s]]`."""
+        fields = self._board[self._ACTION_Y, self._ACTION_X]
+        hashes = np.bitwise_xor.reduce(self._ZOBRIST_SYMMETRIES[:, np.arange(self.actions), fields], axis=1)
+        if self._to_play:
+            hashes ^= self._ZOBRIST_TO_PLAY
+        symmetry = int(np.argmin(hashes))
+        return int(hashes[symmetry]), symmetry
+
+    def _compute_hash(self):
+        hash = self._ZOBRIST_TO_PLAY if self._to_play else 0
+        for action, field in enumerate(self._board[self._ACTION_Y, self._ACTION_X]):
+            hash ^= self._ZOBRIST[action][field]
+        return hash
+
+    def _find(self, cell):
+        while self._parent[cell] != cell:
+            self._parent[cell] = self._parent[self._parent[cell]]
+            cell = self._parent[cell]
+        return cell
+
+    def _union(self, first, second):
+        first, second = self._find(first), self._find(second)
+        if first != second:
+            self._parent[second] = first
+            self._sides[first] |= self._sides[second]
+        return first
 
     def render(self):
         A = 40
@@ -128,6 +226,275 @@ class AZQuiz:
     _ACTION_X = np.array([0,0,1,0,1,2,0,1,2,3,0,1,2,3,4,0,1,2,3,4,5,0,1,2,3,4,5,6], dtype=np.int8)
     _REPRESENTATION = np.array([[0,0,0,1], [0,0,1,1], [1,0,0,1], [0,1,0,1]], dtype=np.bool)
     _SWAP_PLAYERS = np.array([0, 1, 3, 2])
+    _TRIANGLE = np.tri(N, dtype=np.bool)  # Cells of the board, in the order of actions
+    _NEIGHBOURS = tuple(_neighbours(j, i) for j in range(N) for i in range(j + 1))
+    _SIDES = tuple(_sides(j, i) for j in range(N) for i in range(j + 1))
+    _ALL_SIDES = 7
+    _ZOBRIST_KEYS = np.random.RandomState(42).randint(1, 2**63 - 1, size=actions * 4 + 1, dtype=np.int64)
+    _ZOBRIST = (_ZOBRIST_KEYS[:-1].reshape([actions, 4]) * [0, 1, 1, 1]).tolist()  # Empty cells do not change the hash
+    _ZOBRIST_TO_PLAY = int(_ZOBRIST_KEYS[-1])
+    _SYMMETRIES = _symmetries()
+    _SYMMETRIES_INVERSE = np.argsort(_SYMMETRIES, axis=1)
+    _ZOBRIST_SYMMETRIES = np.array(_ZOBRIST, dtype=np.int64)[_SYMMETRIES]
+
+class AZQuizBitboard:
+    """AZQuiz storing the board as 28-bit masks of cells, indexed by actions.
+
+    The interface is the same as of AZQuiz, but cloning, moving and checking
+    the winner only manipulates a few Python integers, which is considerably
+    faster in search-based players.
+    """
+    actions = AZQuiz.actions
+    N = AZQuiz.N
+    C = AZQuiz.C
+
+    def __init__(self, randomized):
+        self._captured = (0, 0)  # Cells captured by either player
+        self._failed = 0         # Cells with a failed question
+        self._randomized = randomized
+        self._to_play = 0
+        self._winner = None
+        self._viewer = None
+        self._hash = 0
+
+    def clone(self):
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone._viewer = None
+        return clone
+
+    @property
+    def board(self):
+        board = np.zeros([self.N, self.N, self.C], dtype=np.bool)
+        board[AZQuiz._ACTION_Y, AZQuiz._ACTION_X] = AZQuiz._REPRESENTATION[self._cells()]
+        return board
+
+    @property
+    def to_play(self):
+        return self._to_play if not self._winner else None
+
+    @property
+    def winner(self):
+        return self._winner
+
+    hash = AZQuiz.hash
+
+    def swap_players(self):
+        self._captured = self._captured[::-1]
+        self._to_play = 1 - self._to_play
+        self._winner = 1 - self._winner if self._winner is not None else None
+        self._hash = self._compute_hash()
+
+    def valid(self, action):
+        return self._winner is None and action >= 0 and action < self.actions \
+            and not ((self._captured[0] | self._captured[1]) >> action) & 1
+
+    def move(self, action):
+        return self._move(action, np.random.uniform() if self._randomized else 0)
+
+    def all_moves(self, action):
+        success = self.clone()
+        success._move(action, 0.)
+        if not self._randomized:
+            return [(1.0, success)]
+
+        failure = self.clone()
+        failure._move(action, 1.)
+        if not (self._failed >> action) & 1:
+            success_probability = AZQuiz._INITIAL_QUESTION_PROB
+        else:
+            success_probability = AZQuiz._ADDITIONAL_QUESTION_PROB
+        return [(success_probability, success), (1. - success_probability, failure)]
+
+    def _move(self, action, random_value):
+        if not self.valid(action):
+            raise ValueError("An invalid action to AZQuiz.move")
+
+        cell = 1 << int(action)
+        if not self._failed & cell:
+            if random_value > AZQuiz._INITIAL_QUESTION_PROB:
+                self._failed |= cell
+                self._to_play = 1 - self._to_play
+                self._hash ^= self._ZOBRIST[action][1] ^ self._ZOBRIST_TO_PLAY
+                return
+            previous = 0
+        else:
+            if random_value > AZQuiz._ADDITIONAL_QUESTION_PROB:
+                self._to_play = 1 - self._to_play
+                self._hash ^= self._ZOBRIST_TO_PLAY
+            self._failed &= ~cell
+            previous = 1
+        player = self._to_play
+        captured = self._captured[player] | cell
+        self._captured = (captured, self._captured[1]) if player == 0 else (self._captured[0], captured)
+        self._to_play = 1 - self._to_play
+        self._hash ^= self._ZOBRIST[action][previous] ^ self._ZOBRIST[action][2 + player] ^ self._ZOBRIST_TO_PLAY
+
+        # Only the component of the newly captured cell can connect all three sides
+        component, frontier = cell, cell
+        while frontier:
+            lowest = frontier & -frontier
+            frontier ^= lowest
+            neighbours = self._NEIGHBOURS[lowest.bit_length() - 1] & captured & ~component
+            component |= neighbours
+            frontier |= neighbours
+        if component & self._LEFT and component & self._RIGHT and component & self._BOTTOM:
+            self._winner = player
+
+    def _cells(self):
+        """Return the AZQuiz cell values (0 empty, 1 failed, 2+player captured) of all actions."""
+        cells = (np.int64(self._failed) >> self._SHIFTS) & 1
+        cells += 2 * ((np.int64(self._captured[0]) >> self._SHIFTS) & 1)
+        cells += 3 * ((np.int64(self._captured[1]) >> self._SHIFTS) & 1)
+        return cells
+
+    @property
+    def _board(self):
+        board = np.zeros([self.N, self.N], dtype=np.uint8)
+        board[AZQuiz._ACTION_Y, AZQuiz._ACTION_X] = self._cells()
+        return board
+
+    render = AZQuiz.render
+    canonical_hash = AZQuiz.canonical_hash
+    _compute_hash = AZQuiz._compute_hash
+
+    _ACTION_Y, _ACTION_X = AZQuiz._ACTION_Y, AZQuiz._ACTION_X
+    _ZOBRIST = AZQuiz._ZOBRIST
+    _ZOBRIST_TO_PLAY = AZQuiz._ZOBRIST_TO_PLAY
+    _ZOBRIST_SYMMETRIES = AZQuiz._ZOBRIST_SYMMETRIES
+
+    _SHIFTS = np.arange(AZQuiz.actions, dtype=np.int64)
+    _NEIGHBOURS = tuple(sum(1 << neighbour for neighbour in neighbours) for neighbours in AZQuiz._NEIGHBOURS)
+    _LEFT = sum(1 << (j * (j + 1) // 2) for j in range(AZQuiz.N))
+    _RIGHT = sum(1 << (j * (j + 1) // 2 + j) for j in range(AZQuiz.N))
+    _BOTTOM = sum(1 << action for action in range(AZQuiz.actions - AZQuiz.N, AZQuiz.actions))
+
+def _neighbour_tables(neighbours, bits):
+    """Tables with the union of the `neighbours` masks of the cells in every `bits`-bit chunk of a cell mask."""
+    tables = np.zeros([(len(neighbours) + bits - 1) // bits, 1 << bits], dtype=np.int64)
+    for cell, mask in enumerate(neighbours):
+        chunk, bit = divmod(cell, bits)
+        tables[chunk, (np.arange(1 << bits) >> bit) & 1 == 1] |= mask
+    return tables
+
+class AZQuizBatch:
+    """Several AZQuiz games played at once with NumPy.
+
+    The boards are stored as cell bitmasks like in AZQuizBitboard, in the
+    arrays `captured` of shape `[games, 2]` and `failed` of shape `[games]`.
+    The `to_play` and `winners` arrays contain the player to move and the
+    winner of every game, with -1 for games without a winner. Finished games
+    are not changed by `step` until they are reset.
+    """
+    actions = AZQuiz.actions
+    N = AZQuiz.N
+    C = AZQuiz.C
+
+    def __init__(self, games, randomized, seed=None):
+        self.np_random = np.random.RandomState(seed)
+        self._randomized = randomized
+        self.captured = np.zeros([games, 2], dtype=np.int64)
+        self.failed = np.zeros([games], dtype=np.int64)
+        self.to_play = np.zeros([games], dtype=np.int8)
+        self.winners = np.full([games], -1, dtype=np.int8)
+
+    @classmethod
+    def from_games(cls, games, seed=None):
+        """Create a batch continuing the given AZQuiz or AZQuizBitboard games."""
+        batch = cls(len(games), games[0]._randomized, seed)
+        cells = np.array([game._board[AZQuiz._ACTION_Y, AZQuiz._ACTION_X] for game in games], dtype=np.int64)
+        batch.failed[:] = np.sum((cells == 1) << AZQuizBitboard._SHIFTS, axis=1)
+        for player in range(2):
+            batch.captured[:, player] = np.sum((cells == 2 + player) << AZQuizBitboard._SHIFTS, axis=1)
+        batch.to_play[:] = [game._to_play for game in games]
+        batch.winners[:] = [-1 if game.winner is None else game.winner for game in games]
+        return batch
+
+    def __len__(self):
+        return len(self.failed)
+
+    def reset(self, games=None):
+        """Start new games, either all of them or those selected by the `games` mask."""
+        games = slice(None) if games is None else games
+        self.captured[games] = 0
+        self.failed[games] = 0
+        self.to_play[games] = 0
+        self.winners[games] = -1
+
+    @property
+    def valid(self):
+        """Mask of valid actions of shape `[games, actions]`."""
+        valid = ((self.captured[:, 0] | self.captured[:, 1])[:, np.newaxis] >> AZQuizBitboard._SHIFTS) & 1 == 0
+        valid &= (self.winners < 0)[:, np.newaxis]
+        return valid
+
+    @property
+    def board(self):
+        """Board tensors of shape `[games, N, N, C]`, equal to `AZQuiz.board` of the individual games."""
+        board = np.zeros([len(self), self.N, self.N, self.C], dtype=np.bool)
+        board[:, AZQuiz._ACTION_Y, AZQuiz._ACTION_X] = AZQuiz._REPRESENTATION[self._cells()]
+        return board
+
+    def random_actions(self):
+        """Uniformly random valid actions of all games (arbitrary ones for finished games)."""
+        return np.argmax(self.np_random.uniform(size=[len(self), self.actions]) * self.valid, axis=1)
+
+    def step(self, actions):
+        """Play the given actions in all unfinished games and return `winners`."""
+        random_values = self.np_random.uniform(size=len(self)) if self._randomized else np.zeros(len(self))
+        return self._step(actions, random_values)
+
+    def _step(self, actions, random_values):
+        games = np.nonzero(self.winners < 0)[0]
+        actions = np.asarray(actions, dtype=np.int64)[games]
+        cells = np.left_shift(1, actions, dtype=np.int64)
+        captured = self.captured[games]
+        if np.any((captured[:, 0] | captured[:, 1]) & cells):
+            raise ValueError("An invalid action to AZQuizBatch.step")
+
+        # Empty cells are captured by the player to move on success, or marked
+        # as failed; failed cells are captured by the player to move on success,
+        # or by the opponent, in which case the player to move does not change.
+        to_play, failed = self.to_play[games], self.failed[games]
+        retried = (failed & cells) != 0
+        success = np.where(retried, random_values[games] <= AZQuiz._ADDITIONAL_QUESTION_PROB,
+                           random_values[games] <= AZQuiz._INITIAL_QUESTION_PROB)
+        self.failed[games] = np.where(retried, failed & ~cells, np.where(success, failed, failed | cells))
+        self.to_play[games] = np.where(retried & ~success, to_play, 1 - to_play)
+        games, cells = games[retried | success], cells[retried | success]
+        owners = np.where(success[retried | success], to_play[retried | success], 1 - to_play[retried | success])
+        self.captured[games, owners] |= cells
+
+        # Only the components of the newly captured cells can connect all three sides
+        components, own = cells.copy(), self.captured[games, owners]
+        growing = np.arange(len(games))
+        while len(growing):
+            component = components[growing]
+            grown = component | (self._neighbours(component) & own[growing])
+            components[growing] = grown
+            growing = growing[grown != component]
+        won = ((components & AZQuizBitboard._LEFT) != 0) & ((components & AZQuizBitboard._RIGHT) != 0) & \
+            ((components & AZQuizBitboard._BOTTOM) != 0)
+        self.winners[games[won]] = owners[won]
+        return self.winners
+
+    def _neighbours(self, masks):
+        """Union of the neighbours of the cells in every mask."""
+        neighbours = np.zeros_like(masks)
+        for chunk, table in enumerate(self._NEIGHBOUR_TABLES):
+            neighbours |= table[(masks >> (chunk * self._CHUNK_BITS)) & ((1 << self._CHUNK_BITS) - 1)]
+        return neighbours
+
+    def _cells(self):
+        """Return the AZQuiz cell values of all games, of shape `[games, actions]`."""
+        shifts = AZQuizBitboard._SHIFTS
+        cells = (self.failed[:, np.newaxis] >> shifts) & 1
+        cells += 2 * ((self.captured[:, 0, np.newaxis] >> shifts) & 1)
+        cells += 3 * ((self.captured[:, 1, np.newaxis] >> shifts) & 1)
+        return cells
+
+    _CHUNK_BITS = 7
+    _NEIGHBOUR_TABLES = _neighbour_tables(AZQuizBitboard._NEIGHBOURS, _CHUNK_BITS)
 
 if __name__ == "__main__":
     quiz = AZQuiz(True)
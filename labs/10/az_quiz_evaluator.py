@@ -1,9 +1,138 @@
 #!/usr/bin/env python3
+import copy
+import math
+import sys
+import time
+
+import numpy as np
+
+import az_quiz
 
 class Player:
-    def play(az_quiz):
+    def play(self, az_quiz):
         raise NotImplementedError()
 
-def evaluate(player):
-    # Will be added later
-    pass
+class RandomPlayer(Player):
+    def play(self, az_quiz):
+        return np.random.choice([action for action in range(az_quiz.actions) if az_quiz.valid(action)])
+
+def play_game(players, randomized, seed):
+    """Play one game of `players[0]` (starting) against `players[1]` and return the winner index.
+
+    The players get a clone of the game; an invalid action loses the game.
+    """
+    np.random.seed(seed)
+    game = az_quiz.AZQuiz(randomized)
+    while game.winner is None:
+        player = game.to_play
+        action = players[player].play(game.clone())
+        if action is None or not game.valid(action):
+            return 1 - player
+        game.move(action)
+    return game.winner
+
+def _play_games(task):
+    # Every chunk plays with fresh copies of the players, both in the process pool and
+    # in this process, so the results depend only on the seed and not on the scheduling.
+    # Transposition tables of the players are kept shared, which in this process lets
+    # them fill across chunks; they cache only deterministic evaluations, so the
+    # results do not change.
+    tables = [getattr(task_player, "transpositions", None) for task_player in task[:2]]
+    player, opponent, randomized, seed, indices = copy.deepcopy(
+        task, {id(table): table for table in tables if table is not None})
+    results = []
+    for index in indices:
+        # The player starts the even games, the opponent the odd ones
+        first = index % 2
+        players = [player, opponent] if first == 0 else [opponent, player]
+        results.append((randomized, first, play_game(players, randomized, seed + index) == first))
+    return results
+
+def _z_score(confidence):
+    """Two-sided standard normal quantile of the given confidence, by bisection."""
+    low, high = 0., 10.
+    for _ in range(60):
+        z = (low + high) / 2
+        low, high = (z, high) if math.erf(z / math.sqrt(2)) < confidence else (low, z)
+    return (low + high) / 2
+
+def _elo(win_rate, games):
+    # The win rate is clipped by half a game (of one more, so that even a single
+    # game gives a nonzero difference), so that the Elo difference stays finite
+    win_rate = min(max(win_rate, 0.5 / (games + 1)), 1 - 0.5 / (games + 1))
+    return 400 * math.log10(win_rate / (1 - win_rate))
+
+def evaluate(player, opponent=None, games=1000, randomized=(False, True), processes=None, seed=42,
+             confidence=0.95, chunk=16, verbose=True):
+    """Play a tournament of `player` against `opponent` (RandomPlayer by default).
+
+    For each variant in `randomized` (a bool or a sequence of them), `games`
+    games are played, with the player starting every other one. Games run in
+    chunks on a pool of `processes` workers (all CPUs by default), so players
+    must be picklable; `processes=1` plays in this process. Every chunk plays
+    with copies of the players, except for their `transpositions` tables, which
+    with `processes=1` are shared by all chunks and filled by the tournament,
+    while in a pool every chunk fills its own copy. Returns a dictionary
+    with results of each variant, containing the number of games and wins,
+    the win rate with its Wilson score confidence interval, the corresponding
+    Elo differences, and the win rates as the first and as the second player
+    (None if no such games were played).
+    """
+    opponent = RandomPlayer() if opponent is None else opponent
+    variants = [randomized] if isinstance(randomized, bool) else list(randomized)
+    tasks = [(player, opponent, variant, seed, range(start, min(start + chunk, games)))
+             for variant in variants for start in range(0, games, chunk)]
+
+    start = time.perf_counter()
+    if processes == 1:
+        results = [result for task in tasks for result in _play_games(task)]
+    else:
+        import multiprocessing
+        with multiprocessing.Pool(processes) as pool:
+            results = [result for results in pool.imap_unordered(_play_games, tasks) for result in results]
+    elapsed = time.perf_counter() - start
+
+    z, report = _z_score(confidence), {}
+    for variant in variants:
+        outcomes = np.array([(first, won) for played, first, won in results if played == variant], dtype=np.int64)
+        n, wins = len(outcomes), int(outcomes[:, 1].sum())
+        win_rate = wins / n
+        # Wilson score interval
+        center = (win_rate + z * z / (2 * n)) / (1 + z * z / n)
+        margin = z * math.sqrt(win_rate * (1 - win_rate) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+        interval = (max(center - margin, 0.), min(center + margin, 1.))
+        report[variant] = {
+            "games": n,
+            "wins": wins,
+            "win_rate": win_rate,
+            "win_rate_interval": interval,
+            "elo": _elo(win_rate, n),
+            "elo_interval": tuple(_elo(bound, n) for bound in interval),
+        }
+        for side, first in [("first", 0), ("second", 1)]:
+            side_wins = outcomes[outcomes[:, 0] == first, 1]
+            report[variant]["win_rate_" + side] = side_wins.mean() if len(side_wins) else None
+        if verbose:
+            result = report[variant]
+            print("{} variant: won {}/{} games, win rate {:.3f} [{:.3f}, {:.3f}], Elo {:+.0f} [{:+.0f}, {:+.0f}], "
+                  "win rate as first {}, as second {}".format(
+                      "Randomized" if variant else "Deterministic", wins, n, win_rate, *interval,
+                      result["elo"], *result["elo_interval"],
+                      *["n/a" if rate is None else "{:.3f}".format(rate)
+                        for rate in [result["win_rate_first"], result["win_rate_second"]]]),
+                  file=sys.stderr)
+    if verbose:
+        print("Played {} games in {:.1f}s".format(len(results), elapsed), file=sys.stderr)
+    return report
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", default=1000, type=int, help="Games of every variant.")
+    parser.add_argument("--processes", default=None, type=int, help="Worker processes, all CPUs by default.")
+    parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+    args = parser.parse_args()
+
+    # Evaluate the random player against itself
+    evaluate(RandomPlayer(), games=args.games, processes=args.processes, seed=args.seed)
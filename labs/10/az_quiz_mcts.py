@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+import functools
+import time
+
+import numpy as np
+
+import az_quiz
+import az_quiz_evaluator
+
+def random_rollouts(games, np_random=None):
+    """Evaluate games by uniform priors and the result of one random playout each.
+
+    Returns `(priors, values)` with priors of shape `[games, actions]` and values
+    from the point of view of the player to move, which is the interface expected
+    from evaluators of MCTSPlayer (for example a network predicting both). The
+    playouts use the given `np.random.RandomState`, if any."""
+    batch = az_quiz.AZQuizBatch.from_games(games)
+    if np_random is not None:
+        batch.np_random = np_random
+    to_play, priors = batch.to_play.copy(), batch.valid.astype(np.float32)
+    while (batch.winners < 0).any():
+        batch.step(batch.random_actions())
+    return priors / np.maximum(priors.sum(axis=1, keepdims=True), 1), np.where(batch.winners == to_play, 1., -1.)
+
+class TranspositionTable:
+    """Bounded cache of position data keyed by Zobrist hashes (`AZQuiz.hash`).
+
+    Every hash maps to a bucket of two entries. The first one is replaced only
+    by entries of at least the same weight (for example the search effort the
+    data represents), the second one by any entry. A shared table can cache
+    evaluations of several players and games; `az_quiz_evaluator.evaluate` keeps
+    it shared only when playing in one process.
+    """
+    def __init__(self, size):
+        self._buckets = max(size // 2, 1)
+        self._keys = [None] * (2 * self._buckets)
+        self._weights = [0] * (2 * self._buckets)
+        self._data = [None] * (2 * self._buckets)
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return sum(key is not None for key in self._keys)
+
+    def get(self, key, default=None):
+        slot = 2 * (key % self._buckets)
+        for slot in [slot, slot + 1]:
+            if self._keys[slot] == key:
+                self.hits += 1
+                return self._data[slot]
+        self.misses += 1
+        return default
+
+    def put(self, key, data, weight=0):
+        slot = 2 * (key % self._buckets)
+        if self._keys[slot] in [key, None] or weight >= self._weights[slot]:
+            if self._keys[slot + 1] == key:
+                self._keys[slot + 1] = None
+        else:
+            slot += 1
+        self._keys[slot], self._weights[slot], self._data[slot] = key, weight, data
+
+class Node:
+    """Decision node of the search tree.
+
+    Statistics of the actions are stored from the point of view of the player
+    to move. Every taken action leads to a chance node, stored in `children` as
+    a list of `[probability, visits, Node]` outcomes given by `AZQuiz.all_moves`.
+    """
+    def __init__(self, game):
+        self.game = game
+        self.priors = None  # Prior probabilities of the actions, once evaluated
+        self.visits = np.zeros(game.actions)
+        self.values = np.zeros(game.actions)
+        self.children = {}
+        self.pending = False
+        self.noisy_priors = None  # Priors mixed with exploration noise, used instead of `priors` in the root
+
+    @property
+    def terminal(self):
+        return self.game.winner is not None
+
+    def select(self, c_puct):
+        priors = self.priors if self.noisy_priors is None else self.noisy_priors
+        scores = self.values / np.maximum(self.visits, 1) + \
+            c_puct * priors * np.sqrt(self.visits.sum() + 1) / (self.visits + 1)
+        scores[self.priors == 0] = -np.inf
+        return int(np.argmax(scores))
+
+    def outcome(self, action):
+        """Return the `[probability, visits, Node]` outcome of the chance node of `action`
+        lagging most behind its probability, counting a visit of it."""
+        if action not in self.children:
+            self.children[action] = [[probability, 0, Node(game)] for probability, game in self.game.all_moves(action)]
+        outcomes = self.children[action]
+        total = sum(outcome[1] for outcome in outcomes)
+        outcome = max(outcomes, key=lambda outcome: outcome[0] * (total + 1) - outcome[1])
+        outcome[1] += 1
+        return outcome
+
+class MCTSPlayer(az_quiz_evaluator.Player):
+    """Monte Carlo Tree Search player with batched leaf evaluation.
+
+    Leaves are evaluated by `evaluate(games)`, returning `(priors, values)` as
+    `random_rollouts` does (which is used with the player random generator
+    when no `evaluate` is given), in batches of up to `batch_size` leaves selected
+    under virtual loss. Every move runs `simulations` simulations, or searches
+    for `time_limit` seconds if given. The subtree of the reached position is
+    reused in the next move. Evaluations of a deterministic `evaluate` (such as
+    a network, but not the random rollouts) can be cached in a TranspositionTable
+    given as `transpositions`, weighted by the number of valid actions, so that
+    positions closer to the start of the game are kept preferably. The cache is
+    keyed by `AZQuiz.canonical_hash`, so symmetric positions share an entry.
+    Whether `evaluate` is deterministic is given by `deterministic_evaluate`,
+    by default true for a given `evaluate`.
+    """
+    REUSE_DEPTH = 4  # Maximum plies between consecutive moves searched for reuse
+
+    def __init__(self, evaluate=None, simulations=800, time_limit=None, batch_size=8,
+                 c_puct=1.25, virtual_loss=1, temperature=0, dirichlet_alpha=None, dirichlet_epsilon=0.25,
+                 transpositions=None, deterministic_evaluate=None, seed=None):
+        self.np_random = np.random.RandomState(seed)
+        self._evaluate = evaluate if evaluate is not None else functools.partial(random_rollouts, np_random=self.np_random)
+        # A single evaluation of a stochastic evaluator would be fixed by caching it
+        if deterministic_evaluate is None:
+            deterministic_evaluate = evaluate is not None
+        if transpositions is not None and not deterministic_evaluate:
+            raise ValueError("Evaluations can be cached in transpositions only for a deterministic evaluate")
+        self.transpositions = transpositions
+        self.simulations = simulations
+        self.time_limit = time_limit
+        self.batch_size = batch_size
+        self.c_puct = c_puct
+        self.virtual_loss = virtual_loss
+        self.temperature = temperature
+        self.dirichlet_alpha = dirichlet_alpha
+        self.dirichlet_epsilon = dirichlet_epsilon
+        self._root = None
+
+    def play(self, az_quiz):
+        policy = self.search(az_quiz)
+        if self.temperature:
+            policy = policy ** (1 / self.temperature)
+            return int(self.np_random.choice(len(policy), p=policy / policy.sum()))
+        return int(np.argmax(policy))
+
+    def search(self, game):
+        """Search from the given game and return the visit distribution of its actions."""
+        if self._root is not None:
+            self._root.noisy_priors = None
+        self._root = self._find(game) or Node(game.clone())
+        self._root.game = game.clone()
+        if self._root.priors is None:
+            self._expand([self._root])
+        if self.dirichlet_alpha is not None:
+            # The noise is mixed into a copy, so that the priors stay clean when the node is reused
+            valid = self._root.priors > 0
+            self._root.noisy_priors = self._root.priors.copy()
+            self._root.noisy_priors[valid] = (1 - self.dirichlet_epsilon) * self._root.priors[valid] + \
+                self.dirichlet_epsilon * self.np_random.dirichlet([self.dirichlet_alpha] * valid.sum())
+
+        start, simulations = time.perf_counter(), 0
+        while (simulations < self.simulations) if self.time_limit is None else \
+                (time.perf_counter() - start < self.time_limit):
+            simulations += self._simulate_batch(self.batch_size if self.time_limit is not None else
+                                                min(self.batch_size, self.simulations - simulations))
+        return self._root.visits / self._root.visits.sum()
+
+    def _simulate_batch(self, leaves):
+        """Run up to `leaves` simulations whose leaves are evaluated together, returning their number."""
+        paths = []
+        for _ in range(leaves):
+            path, node = [], self._root
+            while node.priors is not None and not node.terminal:
+                action = node.select(self.c_puct)
+                node.visits[action] += self.virtual_loss
+                node.values[action] -= self.virtual_loss
+                outcome = node.outcome(action)
+                path.append((node, action, outcome))
+                node = outcome[2]
+            if node.pending:
+                # The leaf is already being evaluated, so undo the selection and stop collecting this batch
+                for parent, action, outcome in path:
+                    parent.visits[action] -= self.virtual_loss
+                    parent.values[action] += self.virtual_loss
+                    outcome[1] -= 1
+                break
+            node.pending = not node.terminal
+            paths.append((path, node))
+
+        leaves = [node for _, node in paths if not node.terminal]
+        values = dict(zip(map(id, leaves), self._expand(leaves))) if leaves else {}
+        for path, node in paths:
+            # The value of the leaf from the point of view of player 0
+            if node.terminal:
+                value = 1. if node.game.winner == 0 else -1.
+            else:
+                value = values[id(node)] if node.game._to_play == 0 else -values[id(node)]
+            for parent, action, _ in path:
+                parent.visits[action] += 1 - self.virtual_loss
+                parent.values[action] += (value if parent.game._to_play == 0 else -value) + self.virtual_loss
+        return max(len(paths), 1)
+
+    def _expand(self, nodes):
+        """Set the priors of the given nodes and return their values."""
+        valid = [np.array([node.game.valid(action) for action in range(node.game.actions)]) for node in nodes]
+        evaluations = [None] * len(nodes)
+        if self.transpositions is not None:
+            # Priors are cached in the orientation of the canonical position
+            keys = [node.game.canonical_hash() for node in nodes]
+            for i, (key, symmetry) in enumerate(keys):
+                evaluation = self.transpositions.get(key)
+                if evaluation is not None:
+                    evaluations[i] = (evaluation[0][az_quiz.AZQuiz._SYMMETRIES[symmetry]], evaluation[1])
+        missing = [i for i, evaluation in enumerate(evaluations) if evaluation is None]
+        if missing:
+            priors, values = self._evaluate([nodes[i].game for i in missing])
+            for i, prior, value in zip(missing, priors, values):
+                evaluations[i] = (prior, value)
+                if self.transpositions is not None:
+                    key, symmetry = keys[i]
+                    self.transpositions.put(key, (np.asarray(prior)[az_quiz.AZQuiz._SYMMETRIES_INVERSE[symmetry]], value),
+                                            weight=valid[i].sum())
+
+        for node, node_valid, (prior, _) in zip(nodes, valid, evaluations):
+            prior = np.where(node_valid, prior, 0)
+            node.priors = prior / prior.sum() if prior.sum() > 0 else node_valid / node_valid.sum()
+            node.pending = False
+        return [value for _, value in evaluations]
+
+    def _find(self, game):
+        """Find the node of the given game among the descendants of the last root."""
+        level = [self._root] if self._root is not None else []
+        for _ in range(self.REUSE_DEPTH + 1):
+            for node in level:
+                if node.game.hash == game.hash:
+                    return node
+            level = [outcome[2] for node in level for outcomes in node.children.values() for outcome in outcomes]
+        return None
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", default=20, type=int, help="Games against a random player.")
+    parser.add_argument("--processes", default=None, type=int, help="Worker processes, all CPUs by default.")
+    parser.add_argument("--randomized", default=False, action="store_true", help="Play the randomized variant.")
+    parser.add_argument("--simulations", default=200, type=int, help="Simulations per move.")
+    parser.add_argument("--time_limit", default=None, type=float, help="Search time per move, instead of simulations.")
+    parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+    args = parser.parse_args()
+
+    player = MCTSPlayer(simulations=args.simulations, time_limit=args.time_limit, seed=args.seed)
+    az_quiz_evaluator.evaluate(player, games=args.games, randomized=args.randomized, processes=args.processes,
+                               seed=args.seed, chunk=1)